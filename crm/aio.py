@@ -0,0 +1,235 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict
+import aiohttp
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from api.espo_api_client import EspoAPIError, EspoAPI404Error
+from crm.client import flatten_params
+from crm.conf import get_setting
+from crm.registry import get_model
+from crm.push import finish_request, is_batchable, prepare_requests, resync_changed
+from crm.breaker import espo_breaker
+from crm.throttle import EspoThrottle, espo_throttle, is_overload_status
+
+
+logger = logging.getLogger(__name__)
+
+
+def in_worker_thread(func):
+    """
+    Обертка для sync_to_async(thread_sensitive=False). Потоки executor не
+    проходят через request_started/request_finished, поэтому устаревшие
+    соединения с базой закрываем сами, как Django вокруг запроса
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+async def take_token(throttle, deadline, rate=None):
+    """
+    Асинхронный EspoThrottle.take_token: токен берется без ожидания
+    в executor, а ждем в asyncio.sleep, не занимая поток
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        delay = await loop.run_in_executor(None, throttle.try_token, rate)
+        if not delay:
+            return
+        if time.time() > deadline:
+            raise EspoAPIError(f'crm rate limit exceeded for {throttle.name}')
+        await asyncio.sleep(delay)
+
+
+async def take_slot(throttle, deadline):
+    loop = asyncio.get_running_loop()
+    attempt = 0
+    while not await loop.run_in_executor(None, throttle.try_slot):
+        if time.time() > deadline:
+            raise EspoAPIError(f'crm concurrency limit exceeded for {throttle.name}')
+        await asyncio.sleep(throttle.get_backoff(attempt))
+        attempt += 1
+
+
+async def throttle_acquire():
+    """
+    Асинхронный espo_throttle.acquire
+    """
+    deadline = time.time() + get_setting('CRM_THROTTLE_WAIT')
+    await take_token(espo_throttle, deadline)
+    if get_setting('CRM_ADAPTIVE_CONCURRENCY'):
+        await take_slot(espo_throttle, deadline)
+
+
+async def model_throttle(model):
+    """
+    Асинхронный CRMSignalMixin.crm_throttle
+    """
+    if model.crm_rate_limit:
+        await take_token(
+            EspoThrottle(f'model:{model.__name__}'),
+            time.time() + get_setting('CRM_THROTTLE_WAIT'), rate=model.crm_rate_limit
+        )
+
+
+class AsyncCRMEspoClient:
+    """
+    Asyncio-клиент EspoApi. Интерфейс и ошибки как у CRMEspoClient, request - корутина
+    """
+    url_path = '/api/v1/'
+
+    def __init__(self, url, api_key, session):
+        self.url = url
+        self.api_key = api_key
+        self.session = session
+
+    async def request(self, method, action, params=None):
+        if params is None:
+            params = {}
+        kwargs = {'headers': {'X-Api-Key': self.api_key}}
+        if method in ('POST', 'PATCH', 'PUT'):
+            kwargs['json'] = params
+        elif params:
+            kwargs['params'] = [(key, str(value)) for key, value in flatten_params(params)]
+        url = f'{self.url}{self.url_path}{action}'
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, espo_breaker.check)
+        await throttle_acquire()
+        started = time.monotonic()
+        overloaded = True
+        try:
+            async with self.session.request(method, url, **kwargs) as response:
+                overloaded = is_overload_status(response.status)
+                if response.status == 404:
+                    raise EspoAPI404Error(f'Wrong request, status code is 404, action is {action}')
+                if response.status != 200:
+                    reason = response.headers.get('X-Status-Reason', 'Unknown Error')
+                    raise EspoAPIError(
+                        f'Wrong request, status code is {response.status}, reason is {reason}'
+                    )
+                body = await response.read()
+                if not body:
+                    raise EspoAPIError('Wrong request, content response is empty')
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            raise EspoAPIError(f'Request to crm failed: {err!r}') from err
+        finally:
+            await loop.run_in_executor(
+                None, self.release, time.monotonic() - started, overloaded
+            )
+
+    def release(self, latency, overloaded):
+        espo_throttle.release(latency, overloaded)
+        if overloaded:
+            espo_breaker.record_failure()
+        else:
+            espo_breaker.record_success()
+
+
+def build_session(concurrency):
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=get_setting('CRM_HTTP_CONNECT_TIMEOUT'),
+        sock_read=get_setting('CRM_HTTP_READ_TIMEOUT'),
+    )
+    connector = aiohttp.TCPConnector(limit=concurrency, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class AsyncCRMPusher:
+    """
+    Пушит записи в crm из одного процесса, держа в полете до concurrency запросов.
+    Загрузка и сериализация идут пачкой на модель через prepare_requests,
+    сеть - конкурентно, запись crm_id - как у синхронного пуша.
+    Строки на время запросов не блокируются, как при CRM_SYNC_SHORT_LOCK,
+    независимо от настройки
+    """
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or get_setting('CRM_ASYNC_CONCURRENCY')
+
+    def load_group(self, class_name, ids):
+        model = get_model(class_name)
+        return model, list(model.get_crm_push_queryset().filter(pk__in=ids))
+
+    def prepare_group(self, model, instances):
+        if not is_batchable(model):
+            return [], {}
+        return prepare_requests(model, instances)
+
+    async def send(self, client, semaphore, request):
+        async with semaphore:
+            await model_throttle(request.instance.__class__)
+            response = await client.request(request.method, request.action, request.data)
+        await sync_to_async(finish_request)(request, response)
+
+    async def push_instance(self, semaphore, instance):
+        async with semaphore:
+            await model_throttle(instance.__class__)
+            await sync_to_async(in_worker_thread(instance.crm_push), thread_sensitive=False)()
+
+    async def push_group(self, client, semaphore, model, instances):
+        """
+        Пушит загруженные инстансы одной модели. Возвращает словарь ошибок {pk: exception}
+        """
+        requests, errors = await sync_to_async(self.prepare_group)(model, instances)
+        if is_batchable(model):
+            keys = [request.instance.pk for request in requests]
+            coros = [self.send(client, semaphore, request) for request in requests]
+        else:
+            keys = [instance.pk for instance in instances]
+            coros = [self.push_instance(semaphore, instance) for instance in instances]
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for pk, result in zip(keys, results):
+            if isinstance(result, Exception):
+                errors[pk] = result
+        if is_batchable(model):
+            sent = [
+                request for request, result in zip(requests, results)
+                if not isinstance(result, Exception)
+            ]
+            await sync_to_async(resync_changed)(model, sent)
+        for pk, err in errors.items():
+            logger.warning('async crm push of %s %s failed: %r', model.__name__, pk, err)
+        return errors
+
+    async def push(self, items):
+        """
+        items - пары (class_name, instance_id).
+        Возвращает словарь ошибок {(class_name, pk): exception}
+        """
+        groups = OrderedDict()
+        for class_name, instance_id in items:
+            groups.setdefault(class_name, []).append(instance_id)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        errors = {}
+        async with build_session(self.concurrency) as session:
+            client = AsyncCRMEspoClient(settings.CRM_URL, settings.CRM_API_KEY, session)
+            for class_name, ids in groups.items():
+                model, instances = await sync_to_async(self.load_group)(class_name, ids)
+                group_errors = await self.push_group(client, semaphore, model, instances)
+                for pk, err in group_errors.items():
+                    errors[(class_name, pk)] = err
+        return errors
+
+    async def push_instances(self, model, instances):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async with build_session(self.concurrency) as session:
+            client = AsyncCRMEspoClient(settings.CRM_URL, settings.CRM_API_KEY, session)
+            return await self.push_group(client, semaphore, model, instances)
+
+    def run(self, items):
+        return asyncio.run(self.push(items))
+
+    def run_instances(self, model, instances):
+        """
+        Пушит уже загруженные инстансы одной модели. Возвращает словарь ошибок {pk: exception}
+        """
+        return asyncio.run(self.push_instances(model, instances))
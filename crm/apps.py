@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class CrmConfig(AppConfig):
     name = 'crm'
+
+    def ready(self):
+        from crm import registry
+        from crm.models import connect_delete_receiver
+        registry.populate()
+        for model in registry.get_models().values():
+            connect_delete_receiver(model)
@@ -0,0 +1,91 @@
+import time
+from api.espo_api_client import EspoAPIError
+from crm.conf import get_cache, get_setting
+
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class CRMCircuitOpenError(EspoAPIError):
+    """
+    crm недоступна, запрос не отправлялся
+    """
+
+
+class EspoCircuitBreaker:
+    """
+    Общий для всех процессов предохранитель запросов в crm, состояние лежит в кэше CRM_CACHE.
+    После CRM_BREAKER_THRESHOLD ошибок (429/5xx/обрывы) за CRM_BREAKER_WINDOW секунд
+    размыкается на CRM_BREAKER_COOLDOWN секунд, потом пропускает
+    CRM_BREAKER_HALF_OPEN_PROBES пробных запросов: успешный замыкает, упавший
+    размыкает снова
+    """
+    def __init__(self, name='espo'):
+        self.name = name
+
+    def get_key(self, suffix):
+        return f'crm:breaker:{self.name}:{suffix}'
+
+    def get_state(self):
+        opened_at = get_cache().get(self.get_key('opened_at'))
+        if opened_at is None:
+            return STATE_CLOSED
+        if time.time() < opened_at + get_setting('CRM_BREAKER_COOLDOWN'):
+            return STATE_OPEN
+        return STATE_HALF_OPEN
+
+    def allow_request(self):
+        if not get_setting('CRM_BREAKER_THRESHOLD'):
+            return True
+        state = self.get_state()
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_OPEN:
+            return False
+        cache = get_cache()
+        key = self.get_key('probes')
+        cache.add(key, 0, get_setting('CRM_BREAKER_COOLDOWN') + get_setting('CRM_BREAKER_WINDOW'))
+        try:
+            return cache.incr(key) <= get_setting('CRM_BREAKER_HALF_OPEN_PROBES')
+        except ValueError:
+            return False
+
+    def open(self):
+        cache = get_cache()
+        cache.set(self.get_key('opened_at'), time.time(), None)
+        cache.delete_many([self.get_key('failures'), self.get_key('probes')])
+
+    def record_success(self):
+        if not get_setting('CRM_BREAKER_THRESHOLD'):
+            return
+        cache = get_cache()
+        if cache.get(self.get_key('opened_at')) is not None:
+            cache.delete_many([self.get_key('opened_at'), self.get_key('probes')])
+        if cache.get(self.get_key('failures')):
+            cache.delete(self.get_key('failures'))
+
+    def record_failure(self):
+        threshold = get_setting('CRM_BREAKER_THRESHOLD')
+        if not threshold:
+            return
+        if self.get_state() != STATE_CLOSED: # упала проба - снова размыкаем
+            self.open()
+            return
+        cache = get_cache()
+        key = self.get_key('failures')
+        cache.add(key, 0, get_setting('CRM_BREAKER_WINDOW'))
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            return
+        if failures >= threshold:
+            self.open()
+
+    def check(self):
+        if not self.allow_request():
+            raise CRMCircuitOpenError('crm circuit breaker is open')
+
+
+espo_breaker = EspoCircuitBreaker()
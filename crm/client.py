@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+from api.espo_api_client import EspoAPIError, EspoAPI404Error
+from crm.conf import get_setting
+from crm.breaker import espo_breaker
+from crm.throttle import espo_throttle, is_overload_status
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def _reset_session():
+    global _session
+    _session = None
+
+
+if hasattr(os, 'register_at_fork'):
+    # Соединения пула нельзя делить между процессами, после форка строим пул заново
+    os.register_at_fork(after_in_child=_reset_session)
+
+
+def build_session():
+    retries = get_setting('CRM_HTTP_RETRIES')
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=0,
+        # POST не повторяем при обрыве после отправки, чтобы не создать дубль в crm
+        allowed_methods=frozenset({'GET', 'PATCH', 'PUT', 'DELETE', 'HEAD', 'OPTIONS'}),
+        backoff_factor=0.1,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=get_setting('CRM_HTTP_POOL_CONNECTIONS'),
+        pool_maxsize=get_setting('CRM_HTTP_POOL_SIZE'),
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def get_session():
+    """
+    Общая на процесс requests.Session с пулом keep-alive соединений
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def flatten_params(params, prefix=None):
+    """
+    Раскладывает вложенные параметры в query string в формате php http_build_query,
+    который ожидает EspoApi: where[0][type]=after
+    """
+    if isinstance(params, dict):
+        items = params.items()
+    else:
+        items = enumerate(params)
+    result = []
+    for key, value in items:
+        name = str(key) if prefix is None else f'{prefix}[{key}]'
+        if isinstance(value, (dict, list, tuple)):
+            result.extend(flatten_params(value, name))
+        elif isinstance(value, bool):
+            result.append((name, 'true' if value else 'false'))
+        elif value is not None:
+            result.append((name, value))
+    return result
+
+
+class CRMEspoClient:
+    """
+    Клиент EspoApi поверх общего пула соединений процесса.
+    Интерфейс request совпадает с клиентом из api.espo_api_client
+    """
+    url_path = '/api/v1/'
+
+    def __init__(self, url, api_key, session=None):
+        self.url = url
+        self.api_key = api_key
+        self.session = session or get_session()
+        self.status_code = None
+
+    def get_timeout(self):
+        return (get_setting('CRM_HTTP_CONNECT_TIMEOUT'), get_setting('CRM_HTTP_READ_TIMEOUT'))
+
+    def request(self, method, action, params=None):
+        if params is None:
+            params = {}
+        kwargs = {
+            'url': f'{self.url}{self.url_path}{action}',
+            'headers': {'X-Api-Key': self.api_key},
+            'timeout': self.get_timeout(),
+        }
+        if method in ('POST', 'PATCH', 'PUT'):
+            kwargs['json'] = params
+        elif params:
+            kwargs['params'] = flatten_params(params)
+        espo_breaker.check()
+        espo_throttle.acquire()
+        started = time.monotonic()
+        overloaded = True
+        try:
+            response = self.session.request(method, **kwargs)
+            overloaded = is_overload_status(response.status_code)
+        except requests.exceptions.RequestException as err:
+            raise EspoAPIError(f'Request to crm failed: {err!r}') from err
+        finally:
+            espo_throttle.release(time.monotonic() - started, overloaded)
+            if overloaded:
+                espo_breaker.record_failure()
+            else:
+                espo_breaker.record_success()
+        self.status_code = response.status_code
+        if response.status_code == 404:
+            raise EspoAPI404Error(f'Wrong request, status code is 404, action is {action}')
+        if response.status_code != 200:
+            reason = response.headers.get('X-Status-Reason', 'Unknown Error')
+            raise EspoAPIError(
+                f'Wrong request, status code is {response.status_code}, reason is {reason}'
+            )
+        if not response.content:
+            raise EspoAPIError('Wrong request, content response is empty')
+        return response.json()
+
+
+def get_client():
+    return CRMEspoClient(settings.CRM_URL, settings.CRM_API_KEY)
+
+
+class CRMEspoClientMixin:
+    """
+    Дает client, работающий через общий пул соединений процесса.
+    Используется моделями, тасками и вьюхами crm вместо EspoClientMixin
+    """
+    @property
+    def client(self):
+        return get_client()
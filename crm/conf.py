@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.core.cache import caches
+
+
+DEFAULTS = {
+    # Алиас кэша, через который воркеры и веб делят служебное состояние синка
+    'CRM_CACHE': 'default',
+    # Окно склейки повторных синков одной записи, сек. 0 - склейка выключена
+    'CRM_SYNC_COALESCE_WINDOW': 0,
+    # Максимальное число записей в одной таске crm.crm_sync_batch
+    'CRM_SYNC_BATCH_SIZE': 100,
+    # Синкать только сохранения, изменившие поля, которые уходят в crm
+    'CRM_SYNC_TRACK_CHANGES': True,
+    # Слать в PATCH только поля, изменившиеся с последнего успешного пуша
+    'CRM_SYNC_MINIMAL_PATCH': False,
+    # Время хранения хэшей последнего отправленного payload записи, сек.
+    'CRM_SYNC_SNAPSHOT_TTL': 60 * 60 * 24 * 30,
+    # Не держать блокировку строки во время запроса в crm при пуше
+    'CRM_SYNC_SHORT_LOCK': False,
+    # Пул HTTP соединений к crm на процесс
+    'CRM_HTTP_POOL_CONNECTIONS': 4,
+    'CRM_HTTP_POOL_SIZE': 10,
+    # Таймауты запроса в crm, сек.
+    'CRM_HTTP_CONNECT_TIMEOUT': 5,
+    'CRM_HTTP_READ_TIMEOUT': 30,
+    # Повторы при обрыве соединения (в т.ч. сброс keep-alive соединения сервером)
+    'CRM_HTTP_RETRIES': 3,
+    # Максимум запросов в полете у асинхронного пушера
+    'CRM_ASYNC_CONCURRENCY': 200,
+    # Писать синки в таблицу CRMOutbox в транзакции сохранения вместо таски на коммит
+    'CRM_SYNC_OUTBOX': False,
+    # Строк outbox за один проход релея
+    'CRM_OUTBOX_BATCH_SIZE': 500,
+    # Пауза релея, когда outbox пуст, сек.
+    'CRM_OUTBOX_POLL_INTERVAL': 1,
+    # На сколько релей арендует строки outbox на время прохода: строки
+    # упавшего посреди прохода релея станут доступны через столько секунд
+    'CRM_OUTBOX_LEASE': 300,
+    # Через сколько повторить синк, упавший при пуше прямо из релея, сек.
+    'CRM_OUTBOX_RETRY_DELAY': 60,
+    # Строк outbox в секунду на все релеи (не дает очереди, накопленной
+    # за время простоя crm, уйти в нее разом). 0 - без ограничения
+    'CRM_OUTBOX_DRAIN_RATE': 50,
+    # Запросов в crm в секунду на все процессы. 0 - без ограничения
+    'CRM_RATE_LIMIT': 0,
+    # AIMD-лимит одновременных запросов в crm на все процессы
+    'CRM_ADAPTIVE_CONCURRENCY': False,
+    'CRM_CONCURRENCY_MIN': 1,
+    'CRM_CONCURRENCY_MAX': 50,
+    # Задержка ответа, до которой лимит конкурентности растет, сек.
+    'CRM_AIMD_LATENCY_TARGET': 1.0,
+    # Во сколько раз уменьшать лимит при 429/5xx/таймаутах
+    'CRM_AIMD_DECREASE': 0.5,
+    # Не чаще одного уменьшения лимита за столько секунд
+    'CRM_AIMD_COOLDOWN': 5,
+    # Сколько ждать разрешения на запрос, прежде чем отдать задачу в ретрай, сек.
+    'CRM_THROTTLE_WAIT': 30,
+    # Время жизни счетчика запросов в полете (лечит утечки от упавших воркеров), сек.
+    'CRM_THROTTLE_STATE_TTL': 300,
+    # Ошибок crm за окно, после которых предохранитель размыкается. 0 - выключен.
+    # Пока он разомкнут, синки копятся в CRMOutbox даже при CRM_SYNC_OUTBOX=False,
+    # поэтому нужен релей (crm_outbox_relay или таска crm.crm_outbox_relay по расписанию)
+    'CRM_BREAKER_THRESHOLD': 0,
+    'CRM_BREAKER_WINDOW': 60,
+    # Сколько предохранитель разомкнут перед пробными запросами, сек.
+    'CRM_BREAKER_COOLDOWN': 60,
+    # Пробных запросов в полуразомкнутом состоянии
+    'CRM_BREAKER_HALF_OPEN_PROBES': 3,
+    # Записей crm на страницу списочного запроса (поллер, пачечный пулл)
+    'CRM_POLL_PAGE_SIZE': 200,
+    # id пользователя crm, от которого идут пуши (его изменения поллер пропускает).
+    # None - берется текущий пользователь API
+    'CRM_API_USER_ID': None,
+    # Пауза поллера изменений crm между проходами, сек.
+    'CRM_POLL_INTERVAL': 60,
+    # Максимум crm_id в одном запросе пачечного пулла
+    'CRM_BULK_PULL_MAX_IDS': 5000,
+    # Кэшировать геокодинг адресов из crm (процессный LRU + таблица CRMGeocodeCache)
+    'CRM_GEOCODE_CACHE': False,
+    # Адресов в процессном LRU
+    'CRM_GEOCODE_CACHE_SIZE': 1024,
+    # Время жизни найденного адреса, сек.
+    'CRM_GEOCODE_CACHE_TTL': 60 * 60 * 24 * 30,
+    # Время жизни ненайденного адреса (ZERO_RESULTS), сек.
+    'CRM_GEOCODE_NEGATIVE_TTL': 60 * 60 * 24,
+    # Разобранных google place адресов в процессном кэше сериализатора
+    'CRM_ADDRESS_COMPONENTS_CACHE_SIZE': 4096,
+    # Сериализовать payload в crm планом, собранным из сериализатора один раз
+    'CRM_SYNC_FASTPATH': False,
+    # Сверять payload плана с DRF и отключать план при расхождении
+    'CRM_SYNC_FASTPATH_VERIFY': False,
+}
+
+
+def get_setting(name):
+    """
+    Возвращает настройку crm из settings или значение по умолчанию
+    """
+    return getattr(settings, name, DEFAULTS[name])
+
+
+def get_cache():
+    return caches[get_setting('CRM_CACHE')]
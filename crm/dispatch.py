@@ -0,0 +1,376 @@
+import logging
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+from petuni_main.celery import app
+from api.espo_api_client import EspoAPIError
+from crm.conf import get_cache, get_setting
+from crm.breaker import STATE_HALF_OPEN, STATE_OPEN, espo_breaker
+from crm.registry import get_model
+from crm.throttle import EspoThrottle
+
+
+logger = logging.getLogger(__name__)
+
+outbox_throttle = EspoThrottle('outbox')
+
+
+class CommitBuffer:
+    """
+    Копит элементы, добавленные за транзакцию, и после коммита отдает их
+    в flush одним списком (повторы по ключу склеиваются).
+    Каждый элемент регистрируется своим on_commit, поэтому откат транзакции
+    или savepoint выкидывает ровно свои элементы. Хук flush один на транзакцию
+    и при каждом добавлении переносится в конец очереди хуков, чтобы
+    выполниться после всех элементов.
+    """
+    def __init__(self, name, flush):
+        self.name = name
+        self.flush = flush
+
+    def _get_state(self, connection):
+        attr = f'crm_{self.name}_buffer'
+        state = getattr(connection, attr, None)
+        if state is None:
+            state = {'pending': OrderedDict(), 'hook': None}
+            setattr(connection, attr, state)
+        return state
+
+    def add(self, key, item, using=None):
+        self.add_many([(key, item)], using=using)
+
+    def add_many(self, items, using=None):
+        """
+        Добавляет пары (key, item) одним хуком: откатываются они тоже вместе
+        """
+        items = list(items)
+        if not items:
+            return
+        connection = transaction.get_connection(using)
+        state = self._get_state(connection)
+
+        def collect():
+            for key, item in items:
+                state['pending'].setdefault(key, item)
+
+        transaction.on_commit(collect, using=using)
+        # flush обычно в самом конце очереди, поэтому ищем с конца
+        hooks = connection.run_on_commit
+        for index in range(len(hooks) - 1, -1, -1):
+            if hooks[index][1] is state['hook']:
+                hooks.append(hooks.pop(index))
+                return
+
+        def flush():
+            state['hook'] = None
+            items = list(state['pending'].values())
+            state['pending'].clear()
+            if items:
+                self.flush(items)
+
+        state['hook'] = flush
+        transaction.on_commit(flush, using=using)
+
+
+def get_coalesce_key(class_name, instance_id):
+    return f'crm:sync:pending:{class_name}:{instance_id}'
+
+
+def release_sync(class_name, instance_id):
+    """
+    Снимает отметку о запланированном синке. Вызывается таской перед пушем,
+    чтобы сохранения во время пуша запланировали новый синк.
+    """
+    if get_setting('CRM_SYNC_COALESCE_WINDOW'):
+        get_cache().delete(get_coalesce_key(class_name, instance_id))
+
+
+def get_routing(class_name):
+    """
+    Опции apply_async (очередь, приоритет) для тасок синка модели
+    """
+    return get_model(class_name).get_crm_routing()
+
+
+def send_syncs(items, producer=None):
+    """
+    Отправляет таски синка для списка (class_name, instance_id).
+    Записи делятся по маршрутам моделей (CRMSignalMixin.get_crm_routing),
+    в каждом маршруте одна запись уходит в crm.crm_sync, несколько - пачками
+    в crm.crm_sync_batch.
+    При включенном CRM_SYNC_COALESCE_WINDOW записи, синк которых уже
+    запланирован, пропускаются, а новые уходят с задержкой на окно склейки.
+    """
+    window = get_setting('CRM_SYNC_COALESCE_WINDOW')
+    options = {}
+    if producer is not None:
+        options['producer'] = producer
+    if window:
+        options['countdown'] = window
+        cache = get_cache()
+        items = [
+            (class_name, instance_id) for class_name, instance_id in items
+            if cache.add(get_coalesce_key(class_name, instance_id), 1, window * 2)
+        ]
+    routes = OrderedDict()
+    for class_name, instance_id in items:
+        routing = get_routing(class_name)
+        key = tuple(sorted(routing.items()))
+        routes.setdefault(key, []).append((class_name, instance_id))
+    batch_size = get_setting('CRM_SYNC_BATCH_SIZE')
+    for key, route_items in routes.items():
+        route_options = dict(options, **dict(key))
+        if len(route_items) == 1:
+            class_name, instance_id = route_items[0]
+            s = app.signature(
+                'crm.crm_sync',
+                kwargs={
+                    'instance_id': instance_id,
+                    'class_name': class_name
+                }
+            )
+            s.apply_async(**route_options)
+            continue
+        for start in range(0, len(route_items), batch_size):
+            s = app.signature(
+                'crm.crm_sync_batch',
+                kwargs={'items': route_items[start:start + batch_size]}
+            )
+            s.apply_async(**route_options)
+
+
+sync_buffer = CommitBuffer('sync', send_syncs)
+
+
+def send_delete(descriptor, producer=None):
+    s = app.signature(
+        'crm.crm_sync_delete',
+        kwargs={
+            'descriptor': descriptor
+        }
+    )
+    s.apply_async(producer=producer, **get_routing(descriptor['class_name']))
+
+
+def send_deletes(descriptors, producer=None):
+    """
+    Отправляет удаления по маршрутам моделей: одно - в crm.crm_sync_delete,
+    несколько - пачками в crm.crm_sync_delete_batch
+    """
+    routes = OrderedDict()
+    for descriptor in descriptors:
+        routing = get_routing(descriptor['class_name'])
+        routes.setdefault(tuple(sorted(routing.items())), []).append(descriptor)
+    batch_size = get_setting('CRM_SYNC_BATCH_SIZE')
+    for key, route_descriptors in routes.items():
+        if len(route_descriptors) == 1:
+            send_delete(route_descriptors[0], producer=producer)
+            continue
+        for start in range(0, len(route_descriptors), batch_size):
+            s = app.signature(
+                'crm.crm_sync_delete_batch',
+                kwargs={'descriptors': route_descriptors[start:start + batch_size]}
+            )
+            s.apply_async(producer=producer, **dict(key))
+
+
+delete_buffer = CommitBuffer('delete', send_deletes)
+
+
+def schedule_sync(instance):
+    """
+    Планирует синк инстанса после коммита текущей транзакции.
+    Повторные сохранения одной записи в транзакции дают одну таску.
+    При CRM_SYNC_OUTBOX вместо таски пишет строку в CRMOutbox в той же транзакции
+    """
+    if get_setting('CRM_SYNC_OUTBOX'):
+        from crm.models import CRMOutbox
+        CRMOutbox.objects.create(
+            class_name=instance.__class__.__name__,
+            instance_id=str(instance.pk),
+        )
+        return
+    key = (instance.__class__.__name__, instance.pk)
+    sync_buffer.add(key, key)
+
+
+def schedule_syncs(model, pks, using=None):
+    """
+    Планирует синк пачки записей одной модели после коммита
+    (bulk-операции crm.managers.CRMQuerySet). Записи уходят пачечными тасками
+    """
+    class_name = model.__name__
+    if get_setting('CRM_SYNC_OUTBOX'):
+        from crm.models import CRMOutbox
+        CRMOutbox.objects.using(using).bulk_create([
+            CRMOutbox(class_name=class_name, instance_id=str(pk)) for pk in pks
+        ])
+        return
+    sync_buffer.add_many((((class_name, pk), (class_name, pk)) for pk in pks), using=using)
+
+
+def schedule_delete(instance):
+    """
+    Планирует удаление записи в crm после коммита текущей транзакции.
+    Удаления за транзакцию (например, каскадные) уходят пачечными тасками
+    """
+    descriptor = instance.get_crm_delete_descriptor()
+    if get_setting('CRM_SYNC_OUTBOX'):
+        from crm.models import CRMOutbox
+        CRMOutbox.objects.create(
+            class_name=descriptor['class_name'],
+            instance_id=str(instance.pk),
+            operation=CRMOutbox.OPERATION_DELETE,
+            crm_id=descriptor['crm_id'],
+            crm_api_path=descriptor['crm_api_path'],
+        )
+        return
+    delete_buffer.add((descriptor['crm_api_path'], descriptor['crm_id']), descriptor)
+
+
+def publish(syncs, deletes):
+    """
+    Отправляет таски для разобранных строк outbox одним соединением с брокером
+    """
+    if app.conf.task_always_eager:
+        acquire = nullcontext()
+    else:
+        acquire = app.producer_or_acquire()
+    with acquire as producer:
+        if syncs:
+            send_syncs(syncs, producer=producer)
+        if deletes:
+            send_deletes(deletes, producer=producer)
+    return {}
+
+
+def postpone(rows, delay):
+    """
+    Возвращает строки outbox в очередь с задержкой
+    """
+    from crm.models import CRMOutbox
+    available_at = timezone.now() + timedelta(seconds=delay)
+    CRMOutbox.objects.bulk_create([
+        CRMOutbox(
+            class_name=row.class_name,
+            instance_id=row.instance_id,
+            operation=row.operation,
+            crm_id=row.crm_id,
+            crm_api_path=row.crm_api_path,
+            available_at=available_at,
+        ) for row in rows
+    ])
+
+
+def park(syncs=(), deletes=()):
+    """
+    Откладывает синки и удаления в CRMOutbox, пока разомкнут предохранитель crm.
+    Их разберет релей, когда crm снова начнет отвечать. Так бывает и при
+    CRM_SYNC_OUTBOX=False, поэтому с CRM_BREAKER_THRESHOLD релей или таска
+    crm.crm_outbox_relay по расписанию должны быть запущены всегда
+    """
+    from crm.models import CRMOutbox
+    rows = [
+        CRMOutbox(class_name=class_name, instance_id=str(instance_id))
+        for class_name, instance_id in syncs
+    ]
+    rows.extend(
+        CRMOutbox(
+            class_name=descriptor['class_name'],
+            instance_id=descriptor['crm_id'],
+            operation=CRMOutbox.OPERATION_DELETE,
+            crm_id=descriptor['crm_id'],
+            crm_api_path=descriptor['crm_api_path'],
+        ) for descriptor in deletes
+    )
+    postpone(rows, get_setting('CRM_BREAKER_COOLDOWN'))
+
+
+def reschedule(pks, delay):
+    """
+    Переносит строки outbox на delay секунд вперед
+    """
+    from crm.models import CRMOutbox
+    CRMOutbox.objects.filter(pk__in=pks).update(
+        available_at=timezone.now() + timedelta(seconds=delay)
+    )
+
+
+def relay_outbox(limit=None, handler=publish):
+    """
+    Забирает пачку готовых строк CRMOutbox (SKIP LOCKED, несколько релеев
+    не мешают друг другу), склеивает повторы и передает в handler.
+    Пока предохранитель crm разомкнут, outbox не разбирается.
+    При CRM_OUTBOX_DRAIN_RATE все релеи вместе делают не больше одного
+    прохода в секунду и не больше CRM_OUTBOX_DRAIN_RATE строк за проход.
+    Строки не удаляются, а арендуются: короткая транзакция переносит их
+    available_at на CRM_OUTBOX_LEASE вперед, handler работает вне транзакции,
+    и только после него строки удаляются. Если релей умер посреди прохода,
+    строки снова станут доступны, когда истечет аренда (доставка хотя бы раз).
+    Строки моделей, которых больше нет, выкидываются.
+    handler(syncs, deletes) возвращает {(class_name, instance_id): exception}
+    для синков, которые не ушли: упавшие с EspoAPIError откладываются,
+    остальные выкидываются. Если handler падает целиком (например, недоступен
+    брокер), все строки откладываются.
+    Возвращает число обработанных строк
+    """
+    from crm.models import CRMOutbox
+    limit = limit or get_setting('CRM_OUTBOX_BATCH_SIZE')
+    state = espo_breaker.get_state()
+    if state == STATE_OPEN:
+        return 0
+    if state == STATE_HALF_OPEN: # пока crm не ответила на пробы, отдаем ей по чуть-чуть
+        limit = min(limit, get_setting('CRM_BREAKER_HALF_OPEN_PROBES'))
+    drain_rate = get_setting('CRM_OUTBOX_DRAIN_RATE')
+    if drain_rate:
+        limit = min(limit, drain_rate)
+        try:
+            outbox_throttle.take_token(time.time() + 1, rate=1)
+        except EspoAPIError: # проход этой секунды уже забрал другой релей
+            return 0
+    with transaction.atomic():
+        rows = list(
+            CRMOutbox.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=timezone.now())
+            .order_by('id')[:limit]
+        )
+        if not rows:
+            return 0
+        reschedule([row.pk for row in rows], get_setting('CRM_OUTBOX_LEASE'))
+    syncs = OrderedDict()
+    deletes = []
+    claimed, dropped = [], []
+    for row in rows:
+        try:
+            get_model(row.class_name)
+        except LookupError:
+            logger.error('crm outbox row %s of unknown model %s dropped', row.pk, row.class_name)
+            dropped.append(row.pk)
+            continue
+        claimed.append(row.pk)
+        if row.operation == CRMOutbox.OPERATION_DELETE:
+            deletes.append(row.get_delete_descriptor())
+        else:
+            syncs.setdefault((row.class_name, row.instance_id), []).append(row.pk)
+    if dropped:
+        CRMOutbox.objects.filter(pk__in=dropped).delete()
+    if not claimed:
+        return len(rows)
+    try:
+        failed = handler(list(syncs), deletes)
+    except Exception:
+        reschedule(claimed, get_setting('CRM_OUTBOX_RETRY_DELAY'))
+        raise
+    retry = []
+    for key, err in (failed or {}).items():
+        if isinstance(err, EspoAPIError):
+            retry.extend(syncs[key])
+        else:
+            logger.error('crm outbox sync %s %s dropped: %r', key[0], key[1], err)
+    if retry:
+        reschedule(retry, get_setting('CRM_OUTBOX_RETRY_DELAY'))
+    CRMOutbox.objects.filter(pk__in=set(claimed) - set(retry)).delete()
+    return len(rows)
@@ -0,0 +1,116 @@
+import json
+import logging
+from collections import OrderedDict
+from operator import attrgetter
+from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+from crm.conf import get_setting
+from crm.serializers import CRMAddressSerializerMixin, get_address_representation
+
+
+logger = logging.getLogger(__name__)
+
+
+class SerializerPlan:
+    """
+    Сериализатор crm, собранный один раз в плоский план: на каждое поле
+    (имя, геттер атрибута, to_representation поля). Повторяет цикл
+    Serializer.to_representation без создания и биндинга сериализатора на каждый инстанс.
+    Для простых полей модели геттер - attrgetter, для остальных - get_attribute поля
+    """
+    def __init__(self, serializer_class):
+        self.serializer = serializer_class()
+        self.model = self.serializer.Meta.model
+        self.steps = [self.compile_field(field) for field in self.serializer._readable_fields]
+        self.with_address = issubclass(serializer_class, CRMAddressSerializerMixin)
+
+    @staticmethod
+    def is_compilable(serializer_class):
+        """
+        План повторяет только Serializer.to_representation и адрес из
+        CRMAddressSerializerMixin, остальные переопределения - через DRF
+        """
+        if not issubclass(serializer_class, serializers.ModelSerializer):
+            return False
+        for klass in serializer_class.__mro__:
+            if klass is serializers.Serializer:
+                return True
+            if 'to_representation' in klass.__dict__ and klass is not CRMAddressSerializerMixin:
+                return False
+        return False
+
+    def compile_field(self, field):
+        getter = field.get_attribute
+        if len(field.source_attrs) == 1:
+            try:
+                model_field = self.model._meta.get_field(field.source_attrs[0])
+            except FieldDoesNotExist:
+                model_field = None
+            if (model_field is not None and model_field.concrete and
+                    not model_field.is_relation and model_field.name == field.source):
+                getter = attrgetter(model_field.attname)
+        return field.field_name, getter, field.to_representation
+
+    def represent(self, instance):
+        ret = OrderedDict()
+        for name, getter, to_representation in self.steps:
+            try:
+                attribute = getter(instance)
+            except SkipField:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            ret[name] = None if check_for_none is None else to_representation(attribute)
+        if self.with_address and hasattr(instance, 'address'):
+            get_address_representation(instance, ret)
+        return ret
+
+
+_plans = {}
+
+
+def get_plan(serializer_class):
+    """
+    План сериализатора из кэша процесса или None, если класс не компилируется
+    """
+    if serializer_class not in _plans:
+        plan = None
+        if SerializerPlan.is_compilable(serializer_class):
+            try:
+                plan = SerializerPlan(serializer_class)
+            except Exception:
+                logger.exception('crm serializer %s is not compiled', serializer_class.__name__)
+        _plans[serializer_class] = plan
+    return _plans[serializer_class]
+
+
+def dump(payload):
+    return json.dumps(payload, cls=DjangoJSONEncoder)
+
+
+def drf_serialize(serializer_class, instances):
+    if len(instances) == 1:
+        return [dict(serializer_class(instances[0]).data)]
+    return [dict(data) for data in serializer_class(instances, many=True).data]
+
+
+def serialize(serializer_class, instances):
+    """
+    payload'ы инстансов для crm. При CRM_SYNC_FASTPATH через план сериализатора,
+    иначе (или если план не собрался) - обычным DRF.
+    CRM_SYNC_FASTPATH_VERIFY сверяет план с DRF и при расхождении отключает план
+    """
+    plan = get_plan(serializer_class) if get_setting('CRM_SYNC_FASTPATH') else None
+    if plan is None:
+        return drf_serialize(serializer_class, instances)
+    payloads = [dict(plan.represent(instance)) for instance in instances]
+    if get_setting('CRM_SYNC_FASTPATH_VERIFY'):
+        expected = drf_serialize(serializer_class, instances)
+        if dump(payloads) != dump(expected):
+            logger.error('crm serializer plan for %s differs from DRF output, plan disabled',
+                         serializer_class.__name__)
+            _plans[serializer_class] = None
+            return expected
+    return payloads
@@ -0,0 +1,122 @@
+import copy
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from django.utils import timezone
+from rest_framework import serializers
+from core.models import Address
+from crm.conf import get_setting
+from crm.models import CRMGeocodeCache
+
+
+class GeocodeLRU:
+    """
+    Процессный LRU-кэш геокодинга. Значение - пара (negative, value или текст ошибки)
+    """
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl):
+        with self.lock:
+            self.items[key] = (time.time() + ttl, entry)
+            self.items.move_to_end(key)
+            while len(self.items) > get_setting('CRM_GEOCODE_CACHE_SIZE'):
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+geocode_lru = GeocodeLRU()
+
+
+def normalize_address(address_string):
+    parts = (' '.join(part.split()) for part in address_string.lower().split(','))
+    return ', '.join(part for part in parts if part)
+
+
+def get_geocode_key(query):
+    return hashlib.md5(query.encode()).hexdigest()
+
+
+def load_entry(key):
+    row = CRMGeocodeCache.objects.filter(key=key, expires_at__gt=timezone.now()).first()
+    if row is None:
+        return None, 0
+    ttl = (row.expires_at - timezone.now()).total_seconds()
+    if row.negative:
+        return (True, row.error), ttl
+    return (False, pickle.loads(row.value)), ttl
+
+
+def store_entry(key, query, entry, ttl):
+    negative, value = entry
+    CRMGeocodeCache.objects.update_or_create(key=key, defaults={
+        'query': query,
+        'negative': negative,
+        'value': None if negative else pickle.dumps(value),
+        'error': value if negative else None,
+        'expires_at': timezone.now() + timedelta(seconds=ttl),
+    })
+    geocode_lru.set(key, entry, ttl)
+
+
+def unpack_entry(entry):
+    negative, value = entry
+    if negative:
+        raise serializers.ValidationError(value)
+    return copy.deepcopy(value)
+
+
+def is_not_found(errors):
+    """
+    Адрес не нашелся (ZERO_RESULTS), а не отказ или сбой геокодера
+    (OVER_QUERY_LIMIT, REQUEST_DENIED, UNKNOWN_ERROR), которые не кэшируются
+    """
+    return any('ZERO_RESULTS' in str(error) for error in errors)
+
+
+def geocode(address_string):
+    """
+    Address.get_address_from_string с кэшем: процессный LRU, затем таблица CRMGeocodeCache.
+    Ключ - нормализованная строка адреса. Ненайденные адреса (ZERO_RESULTS) тоже
+    кэшируются, на CRM_GEOCODE_NEGATIVE_TTL, остальные ошибки - нет.
+    Выключено, пока не задан CRM_GEOCODE_CACHE
+    """
+    if not get_setting('CRM_GEOCODE_CACHE'):
+        return Address.get_address_from_string(address_string)
+    query = normalize_address(address_string)
+    key = get_geocode_key(query)
+    entry = geocode_lru.get(key)
+    if entry is None:
+        entry, ttl = load_entry(key)
+        if entry is not None:
+            geocode_lru.set(key, entry, ttl)
+    if entry is not None:
+        return unpack_entry(entry)
+    try:
+        value = Address.get_address_from_string(address_string)
+    except serializers.ValidationError as err:
+        errors = err.detail if isinstance(err.detail, list) else [err.detail]
+        if is_not_found(errors):
+            store_entry(key, query, (True, str(errors[0])), get_setting('CRM_GEOCODE_NEGATIVE_TTL'))
+        raise
+    store_entry(key, query, (False, value), get_setting('CRM_GEOCODE_CACHE_TTL'))
+    return copy.deepcopy(value)
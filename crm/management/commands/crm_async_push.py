@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from crm.aio import AsyncCRMPusher
+from crm.registry import get_model
+
+
+class Command(BaseCommand):
+    help = ('Пушит записи в crm из одного процесса с ограниченной конкурентностью. '
+            'Без --ids пушит записи get_queryset(), которых еще нет в crm')
+
+    def add_arguments(self, parser):
+        parser.add_argument('class_names', nargs='+', help='Имена классов моделей crm')
+        parser.add_argument('--ids', nargs='*', help='pk записей, по умолчанию - все без crm_id')
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Максимум запросов в полете')
+
+    def get_items(self, class_name, ids):
+        try:
+            model = get_model(class_name)
+        except LookupError as err:
+            raise CommandError(str(err))
+        if ids:
+            return [(class_name, pk) for pk in ids]
+        queryset = model.get_crm_push_queryset().filter(crm_id__isnull=True)
+        return [(class_name, pk) for pk in queryset.values_list('pk', flat=True).iterator()]
+
+    def handle(self, *args, **options):
+        items = []
+        for class_name in options['class_names']:
+            items.extend(self.get_items(class_name, options['ids']))
+        started = time.monotonic()
+        errors = AsyncCRMPusher(options['concurrency']).run(items)
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'pushed {len(items) - len(errors)} of {len(items)} records in {elapsed:.1f}s'
+        )
+        for (class_name, pk), err in errors.items():
+            self.stderr.write(f'{class_name} {pk}: {err}')
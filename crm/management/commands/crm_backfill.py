@@ -0,0 +1,76 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from crm.aio import AsyncCRMPusher
+from crm.models import CRMOutbox, CRMSyncCursor
+from crm.registry import get_model, get_models
+
+
+class Command(BaseCommand):
+    help = ('Заливает существующие записи в crm. Идет по get_queryset() каждой модели '
+            'по возрастанию pk пачками, после каждой пачки сохраняет курсор, '
+            'поэтому после падения продолжает с места остановки. '
+            'Законченный проход курсор сбрасывает')
+
+    def add_arguments(self, parser):
+        parser.add_argument('class_names', nargs='*',
+                            help='Имена классов моделей crm, по умолчанию - все')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help='Максимум запросов в полете')
+        parser.add_argument('--only-missing', action='store_true',
+                            help='Только записи, которых еще нет в crm')
+        parser.add_argument('--reset', action='store_true',
+                            help='Начать заново, сбросив сохраненный курсор')
+
+    def get_models(self, class_names):
+        if not class_names:
+            return list(get_models().values())
+        try:
+            return [get_model(class_name) for class_name in class_names]
+        except LookupError as err:
+            raise CommandError(str(err))
+
+    def iter_chunks(self, queryset, chunk_size, last=None):
+        """
+        Пачки по возрастанию pk отдельным запросом pk > последнего на пачку:
+        без долгого серверного курсора и без сдвига, если записи удаляют
+        """
+        while True:
+            page = queryset if last is None else queryset.filter(pk__gt=last)
+            chunk = list(page[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+            last = chunk[-1].pk
+
+    def backfill(self, model, pusher, options):
+        cursor_name = f'backfill:{model.__name__}'
+        if options['reset']:
+            CRMSyncCursor.set_value(cursor_name, None)
+        cursor = CRMSyncCursor.get_value(cursor_name)
+        queryset = model.get_crm_push_queryset().order_by('pk')
+        if options['only_missing']:
+            queryset = queryset.filter(crm_id__isnull=True)
+        done = failed = 0
+        started = time.monotonic()
+        for chunk in self.iter_chunks(queryset, options['chunk_size'], cursor):
+            errors = pusher.run_instances(model, chunk)
+            if errors: # упавшие записи дошлет релей outbox
+                CRMOutbox.objects.bulk_create([
+                    CRMOutbox(class_name=model.__name__, instance_id=str(pk)) for pk in errors
+                ])
+            CRMSyncCursor.set_value(cursor_name, str(chunk[-1].pk))
+            done += len(chunk)
+            failed += len(errors)
+            rate = done / max(time.monotonic() - started, 0.001)
+            self.stdout.write(f'{model.__name__}: {done} rows, {failed} failed, {rate:.0f} rows/s')
+        # курсор нужен только прерванному проходу, следующий запуск идет с начала
+        CRMSyncCursor.set_value(cursor_name, None)
+        self.stdout.write(self.style.SUCCESS(f'{model.__name__}: done, {done} rows'))
+
+    def handle(self, *args, **options):
+        pusher = AsyncCRMPusher(options['concurrency'])
+        for model in self.get_models(options['class_names']):
+            self.backfill(model, pusher, options)
@@ -0,0 +1,48 @@
+import logging
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from crm.conf import get_setting
+from crm.dispatch import publish, relay_outbox
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Разбирает CRMOutbox и отправляет синки в брокер пачками'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Разобрать outbox один раз и выйти')
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--push', action='store_true',
+                            help='Пушить синки прямо из релея асинхронным пушером, минуя брокер')
+
+    def get_handler(self, push):
+        if not push:
+            return publish
+        from crm.aio import AsyncCRMPusher
+        pusher = AsyncCRMPusher()
+
+        def handler(syncs, deletes):
+            publish([], deletes)
+            errors = pusher.run(syncs)
+            return {(class_name, str(pk)): err for (class_name, pk), err in errors.items()}
+
+        return handler
+
+    def handle(self, *args, **options):
+        handler = self.get_handler(options['push'])
+        while True:
+            close_old_connections()
+            try:
+                count = relay_outbox(options['batch_size'], handler=handler)
+            except Exception:
+                logger.exception('crm outbox relay pass failed')
+                count = 0
+            if count:
+                self.stdout.write(f'relayed {count} outbox rows')
+            if options['once'] and not count:
+                break
+            if not count:
+                time.sleep(get_setting('CRM_OUTBOX_POLL_INTERVAL'))
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from crm.conf import get_setting
+from crm.models import CRMSyncCursor
+from crm.poll import get_pull_views, poll
+
+
+class Command(BaseCommand):
+    help = 'Забирает изменения сущностей crm по modifiedAt и сохраняет их в джанго'
+
+    def add_arguments(self, parser):
+        parser.add_argument('entities', nargs='*',
+                            help='Сущности crm (Contact, Account, ...), по умолчанию - все')
+        parser.add_argument('--page-size', type=int, default=None)
+        parser.add_argument('--loop', action='store_true',
+                            help='Опрашивать crm постоянно с паузой CRM_POLL_INTERVAL')
+        parser.add_argument('--reset', action='store_true',
+                            help='Сбросить отметки и забрать все записи заново')
+
+    def handle(self, *args, **options):
+        entities = options['entities'] or list(get_pull_views())
+        unknown = set(entities) - set(get_pull_views())
+        if unknown:
+            raise CommandError(f'Unknown crm entities: {", ".join(sorted(unknown))}')
+        if options['reset']:
+            CRMSyncCursor.objects.filter(name__in=[f'poll:{entity}' for entity in entities]).delete()
+        while True:
+            close_old_connections()
+            for entity, count in poll(entities, options['page_size']).items():
+                if count:
+                    self.stdout.write(f'{entity}: pulled {count} records')
+            if not options['loop']:
+                break
+            time.sleep(get_setting('CRM_POLL_INTERVAL'))
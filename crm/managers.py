@@ -0,0 +1,84 @@
+from django.conf import settings
+from django.db import models, transaction
+from crm.dispatch import schedule_syncs
+
+
+class CRMQuerySetMixin:
+    """
+    Bulk-операции для моделей crm, которые синкают затронутые записи:
+    bulk_create, bulk_update и update пишут пачкой, а после коммита
+    записи уходят в crm пачечными тасками (как при save(), но без save() и сигналов).
+    Синкаются только записи из get_queryset() модели и только при изменении
+    полей, которые уходят в crm. without_crm_sync() отключает синк
+    """
+    _crm_sync = True
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._crm_sync = self._crm_sync
+        return clone
+
+    def without_crm_sync(self):
+        clone = self._chain()
+        clone._crm_sync = False
+        return clone
+
+    def crm_sync_enabled(self):
+        return self._crm_sync and settings.CRM_ENABLED
+
+    def has_crm_fields(self, field_names):
+        tracked = self.model.get_crm_tracked_fields()
+        if tracked is None:
+            return True
+        return bool(tracked & {self.model._meta.get_field(name).attname for name in field_names})
+
+    def schedule_crm_syncs(self, pks):
+        pks = [pk for pk in pks if pk is not None]
+        if not pks:
+            return
+        pks = list(self.model.get_queryset().using(self.db).filter(pk__in=pks)
+                   .values_list('pk', flat=True))
+        if pks:
+            schedule_syncs(self.model, pks, using=self.db)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if not self.crm_sync_enabled():
+            return super().bulk_create(objs, *args, **kwargs)
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            self.schedule_crm_syncs([obj.pk for obj in objs])
+        for obj in objs:
+            obj.crm_remember_values()
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if not self.crm_sync_enabled():
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        objs = list(objs)
+        changed = [obj.pk for obj in objs if obj.has_crm_changes(fields)]
+        with transaction.atomic(using=self.db):
+            result = super().bulk_update(objs, fields, *args, **kwargs)
+            self.schedule_crm_syncs(changed)
+        for obj in objs:
+            obj.crm_remember_values(fields)
+        return result
+
+    def update(self, **kwargs):
+        if not self.crm_sync_enabled() or not self.has_crm_fields(kwargs):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            pks = list(self.values_list('pk', flat=True))
+            rows = super().update(**kwargs)
+            self.schedule_crm_syncs(pks)
+        return rows
+
+
+class CRMQuerySet(CRMQuerySetMixin, models.QuerySet):
+    pass
+
+
+class CRMManager(models.Manager.from_queryset(CRMQuerySet)):
+    """
+    Менеджер для наследников CRMSignalMixin: objects = CRMManager().
+    Для своих QuerySet - подмешать CRMQuerySetMixin
+    """
@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CRMOutbox',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('class_name', models.CharField(max_length=100)),
+                ('instance_id', models.CharField(max_length=64)),
+                ('operation', models.CharField(choices=[('sync', 'sync'), ('delete', 'delete')], default='sync', max_length=10)),
+                ('crm_id', models.CharField(blank=True, max_length=18, null=True)),
+                ('crm_api_path', models.CharField(blank=True, max_length=100, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
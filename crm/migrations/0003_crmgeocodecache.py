@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0002_crmsynccursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CRMGeocodeCache',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=32, unique=True)),
+                ('query', models.TextField()),
+                ('value', models.BinaryField(null=True)),
+                ('negative', models.BooleanField(default=False)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,9 +1,17 @@
+import copy
+import time
 from django.db import models, transaction
-from django.dispatch import receiver
-from django.db.models.signals import post_delete
-from api.espo_api_client import EspoClientMixin
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.signals import class_prepared, post_delete
 from django.conf import settings
-from petuni_main.celery import app
+from django.utils import timezone
+from rest_framework import serializers
+from crm.dispatch import schedule_delete, schedule_sync
+from crm.conf import get_setting
+from crm.client import CRMEspoClientMixin
+from crm.throttle import EspoThrottle
+from crm import registry
+from crm.push import build_request, finish_request, remember_payload, resync_changed
 
 
 CRM_DO_NOTHING = 0
@@ -11,13 +19,27 @@ CRM_SOFT_DELETE = 1
 CRM_TRUE_DELETE = 2
 
 
-class CRMSignalMixin(EspoClientMixin, models.Model):
+def copy_saved_value(value):
+    """
+    Копия значения поля для сравнения при следующем save. Копируются только
+    изменяемые контейнеры (JSONField, ArrayField), остальное хранится как есть
+    """
+    if isinstance(value, (dict, list, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+class CRMSignalMixin(CRMEspoClientMixin, models.Model):
     crm_id = models.CharField(max_length=18, null=True, blank=True, unique=True)
     crm_api_path = None
     serializer_class = None
     request_type = None
     queryset = None
     sync_delete = CRM_DO_NOTHING # 0 не делаем ничего, 1 - шлем PATCH, 2 - шлем DELETE
+    crm_tracked_fields = None # поля модели, изменение которых синкается. None - берем из serializer_class
+    crm_queue = None # очередь celery для тасок синка модели. None - очередь по умолчанию
+    crm_priority = None # приоритет тасок синка модели
+    crm_rate_limit = None # запросов в crm в секунду по этой модели на все воркеры
 
     
     def get_crm_api_action(self):
@@ -35,6 +57,21 @@ class CRMSignalMixin(EspoClientMixin, models.Model):
             return cls.objects.all()
         return cls.queryset
 
+    @classmethod
+    def get_crm_push_queryset(cls):
+        """
+        get_queryset для пачечного пуша: адрес, который нужен сериализатору crm,
+        подгружается тем же запросом
+        """
+        queryset = cls.get_queryset()
+        try:
+            field = cls._meta.get_field('address')
+        except FieldDoesNotExist:
+            return queryset
+        if field.many_to_one or field.one_to_one:
+            queryset = queryset.select_related('address')
+        return queryset
+
     @classmethod
     def get_crm_serializer_class(cls):
         """
@@ -43,6 +80,28 @@ class CRMSignalMixin(EspoClientMixin, models.Model):
         assert cls.serializer_class is not None, f'serializer for {cls.__name__} is undefined'
         return cls.serializer_class
 
+    @classmethod
+    def get_crm_routing(cls):
+        """
+        Возвращает опции apply_async для тасок синка и удаления модели
+        """
+        routing = {}
+        if cls.crm_queue is not None:
+            routing['queue'] = cls.crm_queue
+        if cls.crm_priority is not None:
+            routing['priority'] = cls.crm_priority
+        return routing
+
+    @classmethod
+    def crm_throttle(cls):
+        """
+        Ждет разрешения на запрос в crm по лимиту crm_rate_limit модели
+        """
+        if cls.crm_rate_limit:
+            EspoThrottle(f'model:{cls.__name__}').take_token(
+                time.time() + get_setting('CRM_THROTTLE_WAIT'), rate=cls.crm_rate_limit
+            )
+
     def get_request_type(self):
         """
         Возвращает method для запроса EspoApi
@@ -59,6 +118,16 @@ class CRMSignalMixin(EspoClientMixin, models.Model):
         assert self.sync_delete is not None, f'sync_delete for {self.__class__.__name__} is undefined'
         return self.sync_delete
 
+    def get_crm_delete_descriptor(self):
+        """
+        Компактное описание удаленной записи для таски crm.crm_sync_delete
+        """
+        return {
+            'class_name': self.__class__.__name__,
+            'crm_id': self.crm_id,
+            'crm_api_path': self.crm_api_path,
+        }
+
     def crm_sync_delete(self):
         """
         Синхронизация удаления
@@ -70,22 +139,37 @@ class CRMSignalMixin(EspoClientMixin, models.Model):
 
     def send_espo_request(self, *args, **kwargs):
         """
-        Синхронизация сохранения модели с crm
+        Синхронизация сохранения модели с crm.
+        При CRM_SYNC_SHORT_LOCK строка блокируется только на время сериализации,
+        запрос в crm идет без блокировки, а crm_id записывается условным update
         """
+        from crm.fastpath import serialize
         queryset = self.get_queryset()
         queryset = queryset.select_for_update()
+        if get_setting('CRM_SYNC_SHORT_LOCK'):
+            with transaction.atomic():
+                instance = queryset.get(pk=self.pk)
+                serializer_ = instance.get_crm_serializer_class()
+                request = build_request(instance, serialize(serializer_, [instance])[0])
+            if request is None: # с прошлого пуша в crm ничего не изменилось
+                return
+            response = self.client.request(request.method, request.action, request.data)
+            finish_request(request, response)
+            resync_changed(self.__class__, [request])
+            self.crm_id = instance.crm_id
+            return
         with transaction.atomic():
             instance = queryset.get(pk=self.pk) # TODO теперь мы берем инстанс в самой таске.
                                                 # можно переделать через селф
             serializer_ = instance.get_crm_serializer_class()
-            data = serializer_(instance).data
-            data['skipDuplicateCheck'] = True
-            method = instance.get_request_type()
-            action = instance.get_crm_api_action()
-            response = self.client.request(method, action, data)
+            request = build_request(instance, serialize(serializer_, [instance])[0])
+            if request is None: # с прошлого пуша в crm ничего не изменилось
+                return
+            response = self.client.request(request.method, request.action, request.data)
             if not instance.crm_id:
                 instance.crm_id = response.get('id')
                 instance.save(*args, dont_sync=True, **kwargs)
+            remember_payload(instance, request.payload)
     
     def crm_request_related_link(self, category_id, link):
         """
@@ -105,33 +189,193 @@ class CRMSignalMixin(EspoClientMixin, models.Model):
         """
         self.send_espo_request(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.crm_remember_values()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.crm_remember_values(fields)
+
+    @classmethod
+    def get_crm_tracked_fields(cls):
+        """
+        Возвращает attname полей модели, которые попадают в запрос crm, или None,
+        если набор определить не удалось (тогда синкается каждое сохранение).
+        Поля берутся из crm_tracked_fields, либо из source полей serializer_class.
+        Сериализаторы с адресом или полями через связи отдают None
+        """
+        if '_crm_tracked_attnames' not in cls.__dict__:
+            cls._crm_tracked_attnames = cls._resolve_crm_tracked_fields()
+        return cls._crm_tracked_attnames
+
+    @classmethod
+    def _resolve_crm_tracked_fields(cls):
+        from crm.serializers import CRMAddressSerializerMixin
+        names = cls.crm_tracked_fields
+        if names is None:
+            try:
+                serializer_class = cls.get_crm_serializer_class()
+                fields = serializer_class().fields.values()
+            except Exception:
+                return None
+            # адрес и поля через связи (source с точкой, вложенные сериализаторы)
+            # берут данные из других строк, их изменения по своей строке не видны
+            if issubclass(serializer_class, CRMAddressSerializerMixin):
+                return None
+            names = set()
+            for field in fields:
+                if (field.source == '*' or '.' in field.source or
+                        isinstance(field, serializers.BaseSerializer)):
+                    return None
+                names.add(field.source)
+        attnames = set()
+        for name in names:
+            if name == 'pk':
+                attnames.add(cls._meta.pk.attname)
+                continue
+            try:
+                model_field = cls._meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if model_field.concrete and not model_field.many_to_many:
+                attnames.add(model_field.attname)
+        return frozenset(attnames)
+
+    def _get_attnames(self, field_names):
+        return {self._meta.get_field(name).attname for name in field_names}
+
+    def crm_remember_values(self, field_names=None):
+        """
+        Запоминает значения отслеживаемых полей как сохраненные в базе
+        """
+        if not get_setting('CRM_SYNC_TRACK_CHANGES'):
+            return
+        tracked = self.get_crm_tracked_fields()
+        if tracked is None:
+            return
+        if field_names is None or not hasattr(self, '_crm_saved_values'):
+            self._crm_saved_values = {}
+            attnames = tracked
+        else:
+            attnames = tracked & self._get_attnames(field_names)
+        for attname in attnames:
+            if attname in self.__dict__:
+                self._crm_saved_values[attname] = copy_saved_value(self.__dict__[attname])
+
+    def has_crm_changes(self, update_fields=None):
+        """
+        Проверяет, изменилось ли с загрузки хоть одно поле, которое уходит в crm.
+        Новые и еще не созданные в crm записи считаются измененными.
+        """
+        tracked = self.get_crm_tracked_fields()
+        if (tracked is None or self._state.adding or not self.crm_id or
+                not hasattr(self, '_crm_saved_values') or
+                not get_setting('CRM_SYNC_TRACK_CHANGES')):
+            return True
+        if update_fields is not None:
+            tracked = tracked & self._get_attnames(update_fields)
+        for attname in tracked:
+            if attname not in self._crm_saved_values:
+                if attname in self.__dict__:
+                    return True
+            elif self.__dict__.get(attname) != self._crm_saved_values[attname]:
+                return True
+        return False
+
     def save(self, *args, **kwargs):
         dont_sync = kwargs.pop('dont_sync', False)
+        has_changes = self.has_crm_changes(kwargs.get('update_fields'))
         with transaction.atomic():
             super().save(*args, **kwargs)
-            if (dont_sync != True and settings.CRM_ENABLED and
+            if (dont_sync != True and has_changes and settings.CRM_ENABLED and
                              self.get_queryset().filter(pk=self.pk).exists()):
-                s = app.signature(
-                    'crm.crm_sync',
-                    kwargs={
-                        'instance_id': self.pk,
-                        'class_name': self.__class__.__name__
-                    }
-                )
-                transaction.on_commit(lambda: s.apply_async())
+                schedule_sync(self)
+        self.crm_remember_values(kwargs.get('update_fields'))
 
     class Meta:
         abstract = True
 
 
-@receiver(post_delete)
+class_prepared.connect(registry.on_class_prepared, dispatch_uid='crm_registry')
+
+
+class CRMSyncCursor(models.Model):
+    """
+    Курсоры синхронизации с crm (чекпоинты бэкфилла, отметки поллера), по одному на name
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.CharField(max_length=100, null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_value(cls, name):
+        return cls.objects.filter(name=name).values_list('value', flat=True).first()
+
+    @classmethod
+    def set_value(cls, name, value):
+        cls.objects.update_or_create(name=name, defaults={'value': value})
+
+
+class CRMOutbox(models.Model):
+    """
+    Синки и удаления, записанные в транзакции сохранения.
+    Разбирается релеем (crm.dispatch.relay_outbox) и отправляется в брокер пачками
+    """
+    OPERATION_SYNC = 'sync'
+    OPERATION_DELETE = 'delete'
+    OPERATION_CHOICES = (
+        (OPERATION_SYNC, 'sync'),
+        (OPERATION_DELETE, 'delete'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    class_name = models.CharField(max_length=100)
+    instance_id = models.CharField(max_length=64)
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES, default=OPERATION_SYNC)
+    crm_id = models.CharField(max_length=18, null=True, blank=True) # только для удаления
+    crm_api_path = models.CharField(max_length=100, null=True, blank=True) # только для удаления
+    created = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def get_delete_descriptor(self):
+        return {
+            'class_name': self.class_name,
+            'crm_id': self.crm_id,
+            'crm_api_path': self.crm_api_path,
+        }
+
+
+class CRMGeocodeCache(models.Model):
+    """
+    Результаты геокодинга адресов из crm. negative - адрес не нашелся (ZERO_RESULTS),
+    тогда в error лежит текст ошибки валидации
+    """
+    key = models.CharField(max_length=32, unique=True)
+    query = models.TextField()
+    value = models.BinaryField(null=True)
+    negative = models.BooleanField(default=False)
+    error = models.TextField(null=True, blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+
 def crm_sync_delete(sender, instance, **kwargs):
-    if isinstance(instance, CRMSignalMixin) and instance.sync_delete == CRM_TRUE_DELETE:
-        with transaction.atomic():
-            s = app.signature(
-                    'crm.crm_sync_delete',
-                    kwargs={
-                        'instance': instance
-                    }       
-            )
-            transaction.on_commit(lambda:s.apply_async())
\ No newline at end of file
+    if instance.sync_delete == CRM_TRUE_DELETE and instance.crm_id:
+        schedule_delete(instance)
+
+
+def connect_delete_receiver(sender, **kwargs):
+    """
+    Подключает crm_sync_delete к post_delete только моделей crm
+    """
+    if issubclass(sender, CRMSignalMixin) and not sender._meta.abstract:
+        post_delete.connect(crm_sync_delete, sender=sender,
+                            dispatch_uid=f'crm_sync_delete:{sender._meta.label}')
+
+
+class_prepared.connect(connect_delete_receiver, dispatch_uid='crm_sync_delete')
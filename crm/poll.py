@@ -0,0 +1,133 @@
+import logging
+from collections import OrderedDict
+from api.espo_api_client import EspoAPIError
+from crm.client import get_client
+from crm.conf import get_setting
+from crm.models import CRMSyncCursor
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_pull_views():
+    """
+    Вьюхи пулла по сущностям crm. Импорт внутри: вьюхи тянут модели всех приложений
+    """
+    from crm.views import (CRMAccountPullView, CRMAccountScheduleView, CRMClinicServiceOfferView,
+                           CRMContactView)
+    views = OrderedDict()
+    for view_class in (CRMContactView, CRMAccountScheduleView, CRMClinicServiceOfferView):
+        views[view_class.serializer_class.Meta.model.crm_api_path] = view_class
+    views['Account'] = CRMAccountPullView
+    return views
+
+
+class CRMPoller:
+    """
+    Забирает изменения сущности crm списком, отсортированным по modifiedAt,
+    и сохраняет их через вьюху пулла. Отметка последнего modifiedAt хранится
+    в CRMSyncCursor, следующий проход начинается с нее. Записи с modifiedAt,
+    равным отметке, забираются повторно - сохранение идемпотентно.
+    Записи, последним изменением которых был наш же пуш (modifiedById -
+    пользователь API), пропускаются: иначе поллер затирал бы ими локальные
+    правки, синк которых еще не ушел.
+    Удаления в списке не видны, их по-прежнему приносит вебхук
+    """
+    def __init__(self, entity, view_class, page_size=None):
+        self.entity = entity
+        self.view = view_class.get_pull_view()
+        self.page_size = page_size or get_setting('CRM_POLL_PAGE_SIZE')
+        self.client = get_client()
+        self.api_user_id = None
+
+    def get_api_user_id(self):
+        """
+        id пользователя crm, от которого идут наши пуши: CRM_API_USER_ID,
+        а если не задан - текущий пользователь API по App/user
+        """
+        if self.api_user_id is None:
+            self.api_user_id = get_setting('CRM_API_USER_ID')
+            if not self.api_user_id:
+                try:
+                    self.api_user_id = self.client.request('GET', 'App/user')['user']['id']
+                except (EspoAPIError, KeyError, TypeError):
+                    logger.exception('crm poll failed to get api user, own changes are applied')
+                    self.api_user_id = ''
+        return self.api_user_id
+
+    def is_own_change(self, data):
+        api_user_id = self.get_api_user_id()
+        return bool(api_user_id) and data.get('modifiedById') == api_user_id
+
+    @property
+    def cursor_name(self):
+        return f'poll:{self.entity}'
+
+    def get_params(self, since, offset):
+        params = {
+            'orderBy': 'modifiedAt',
+            'order': 'asc',
+            'maxSize': self.page_size,
+            'offset': offset,
+        }
+        if since:
+            params['where'] = [
+                {'type': 'greaterThanOrEquals', 'attribute': 'modifiedAt', 'value': since},
+            ]
+        return params
+
+    def fetch_page(self, since, offset):
+        return self.client.request('GET', self.entity, self.get_params(since, offset))['list']
+
+    def report_error(self, crm_id, err):
+        logger.warning('crm poll of %s %s failed: %r', self.entity, crm_id, err)
+        try:
+            self.client.request('PATCH', f'{self.entity}/{crm_id}', {'syncFailed': str(err)})
+        except EspoAPIError:
+            logger.exception('crm poll failed to report error for %s %s', self.entity, crm_id)
+
+    def poll(self):
+        """
+        Забирает все изменения с прошлого прохода. Возвращает число сохраненных записей.
+        Листает ключом по modifiedAt, а не offset'ом: список меняется во время прохода
+        (в т.ч. от наших же пушей), и offset пропускал бы записи. Записи с modifiedAt,
+        равным ключу, которые уже сохранены в этом проходе, пропускаются
+        """
+        since = CRMSyncCursor.get_value(self.cursor_name)
+        seen = set() # id записей с modifiedAt == since, сохраненных в этом проходе
+        offset = total = 0
+        while True:
+            records = self.fetch_page(since, offset)
+            if not records:
+                break
+            fresh = [data for data in records
+                     if not (data['modifiedAt'] == since and data['id'] in seen)
+                     and not self.is_own_change(data)]
+            if fresh:
+                for crm_id, result in self.view.apply_many(fresh).items():
+                    if isinstance(result, Exception):
+                        self.report_error(crm_id, result)
+            total += len(fresh)
+            last = records[-1]['modifiedAt']
+            if last != since:
+                since, offset = last, 0
+                seen = {data['id'] for data in records if data['modifiedAt'] == last}
+            else:
+                # вся страница с одним modifiedAt: ключом не сдвинуться, листаем внутри него
+                seen.update(data['id'] for data in records)
+                offset += len(records)
+            CRMSyncCursor.set_value(self.cursor_name, since)
+            if len(records) < self.page_size:
+                break
+        return total
+
+
+def poll(entities=None, page_size=None):
+    """
+    Проход поллера по сущностям crm. Возвращает {сущность: число записей}
+    """
+    views = get_pull_views()
+    result = OrderedDict()
+    for entity in entities or views:
+        result[entity] = CRMPoller(entity, views[entity], page_size).poll()
+    return result
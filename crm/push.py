@@ -0,0 +1,245 @@
+import hashlib
+import json
+import logging
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from api.espo_api_client import EspoAPIError
+from crm.conf import get_cache, get_setting
+from crm.dispatch import schedule_syncs
+
+
+logger = logging.getLogger(__name__)
+
+
+class PushRequest:
+    """
+    Запрос в crm для одного инстанса, собранный до отправки.
+    payload - полное представление записи, data - то, что уйдет в запросе
+    """
+    def __init__(self, instance, method, action, payload, data):
+        self.instance = instance
+        self.method = method
+        self.action = action
+        self.payload = payload
+        self.data = data
+
+
+def is_batchable(model):
+    """
+    Модели с переопределенной отправкой (например, с дополнительными связями в crm)
+    пушатся поштучно через crm_push
+    """
+    from crm.models import CRMSignalMixin
+    return (model.crm_push is CRMSignalMixin.crm_push and
+            model.send_espo_request is CRMSignalMixin.send_espo_request)
+
+
+def get_snapshot_key(instance):
+    return f'crm:sync:payload:{instance.__class__.__name__}:{instance.pk}'
+
+
+def hash_value(value):
+    dump = json.dumps(value, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.md5(dump.encode()).hexdigest()
+
+
+def get_changed_data(instance, payload):
+    """
+    Оставляет в payload только ключи, изменившиеся с последнего успешного пуша.
+    Без снимка (или если снимок снят для другой записи в crm) отдает payload целиком
+    """
+    snapshot = get_cache().get(get_snapshot_key(instance))
+    if snapshot is None or snapshot['crm_id'] != instance.crm_id:
+        return payload
+    return {
+        key: value for key, value in payload.items()
+        if snapshot['fields'].get(key) != hash_value(value)
+    }
+
+
+def remember_payload(instance, payload):
+    """
+    Сохраняет хэши полей отправленного payload как подтвержденные crm
+    """
+    if not get_setting('CRM_SYNC_MINIMAL_PATCH') or not instance.crm_id:
+        return
+    snapshot = {
+        'crm_id': instance.crm_id,
+        'fields': {key: hash_value(value) for key, value in payload.items()},
+    }
+    get_cache().set(get_snapshot_key(instance), snapshot, get_setting('CRM_SYNC_SNAPSHOT_TTL'))
+
+
+def forget_payload(instance):
+    """
+    Сбрасывает снимок отправленного payload, когда в запись пришли данные из crm:
+    после этого снимок уже не совпадает с тем, что лежит в crm
+    """
+    if instance is not None and instance.pk is not None:
+        get_cache().delete(get_snapshot_key(instance))
+
+
+def build_request(instance, payload):
+    """
+    Собирает PushRequest. При CRM_SYNC_MINIMAL_PATCH для PATCH отправляются
+    только изменившиеся поля, а если не изменилось ничего, возвращает None
+    """
+    method = instance.get_request_type()
+    data = payload
+    if method == 'PATCH' and get_setting('CRM_SYNC_MINIMAL_PATCH'):
+        data = get_changed_data(instance, payload)
+        if not data:
+            return None
+    data = dict(data, skipDuplicateCheck=True)
+    return PushRequest(instance, method, instance.get_crm_api_action(), payload, data)
+
+
+def prepare_requests(model, instances):
+    """
+    Сериализует инстансы одним проходом. Если сериализация пачки падает,
+    сериализуем поштучно, чтобы ошибка одной записи не валила остальные.
+    Возвращает список PushRequest и словарь ошибок {pk: exception}
+    """
+    from crm.fastpath import serialize
+    serializer_ = model.get_crm_serializer_class()
+    requests, errors = [], {}
+    try:
+        payloads = serialize(serializer_, instances)
+    except Exception:
+        payloads = None
+    if payloads is not None:
+        requests = [
+            build_request(instance, data) for instance, data in zip(instances, payloads)
+        ]
+    else:
+        for instance in instances:
+            try:
+                requests.append(build_request(instance, serialize(serializer_, [instance])[0]))
+            except Exception as err:
+                errors[instance.pk] = err
+    return [request for request in requests if request is not None], errors
+
+
+def save_crm_id(instance, crm_id):
+    """
+    Записывает crm_id созданной в crm записи условным update (crm_id IS NULL),
+    без блокировки строки на время запроса.
+    Возвращает False, если crm_id уже успел записать параллельный пуш,
+    и None, если запись удалили, пока шел запрос
+    """
+    if instance.crm_id or not crm_id:
+        return True
+    updated = instance.__class__._base_manager.filter(
+        pk=instance.pk, crm_id__isnull=True
+    ).update(crm_id=crm_id)
+    if not updated:
+        try:
+            instance.refresh_from_db(fields=['crm_id'])
+        except instance.__class__.DoesNotExist:
+            return None
+        return False
+    instance.crm_id = crm_id
+    return True
+
+
+def finish_request(request, response):
+    """
+    Обрабатывает ответ crm. Если запись параллельно уже создали в crm,
+    созданный этим запросом дубль удаляется. Если запись удалили у нас
+    (post_delete ее пропустил - crm_id еще не было), созданная запись
+    удаляется только у моделей с CRM_TRUE_DELETE
+    """
+    from crm.models import CRM_TRUE_DELETE
+    instance = request.instance
+    crm_id = response.get('id')
+    saved = save_crm_id(instance, crm_id)
+    if saved is None and instance.get_sync_delete() != CRM_TRUE_DELETE:
+        return
+    if not saved:
+        logger.warning('orphan crm record %s for %s %s removed', crm_id,
+                       instance.__class__.__name__, instance.pk)
+        instance.client.request('DELETE', f'{instance.crm_api_path}/{crm_id}')
+        return
+    remember_payload(instance, request.payload)
+
+
+def resync_changed(model, requests):
+    """
+    Без блокировки строки на время запроса пуши одной записи могут дойти
+    до crm не в том порядке, в каком сериализовались, и оставить в ней
+    старые данные. После ответа перечитываем записи одним запросом и,
+    если они изменились с сериализации, планируем еще один синк
+    """
+    from crm.fastpath import serialize
+    if not requests:
+        return
+    instances = list(
+        model.get_crm_push_queryset().filter(pk__in=[request.instance.pk for request in requests])
+    )
+    if not instances:
+        return
+    payloads = serialize(model.get_crm_serializer_class(), instances)
+    current = {instance.pk: hash_value(data) for instance, data in zip(instances, payloads)}
+    changed = [
+        request.instance.pk for request in requests
+        if request.instance.pk in current and current[request.instance.pk] != hash_value(request.payload)
+    ]
+    if changed:
+        schedule_syncs(model, changed)
+
+
+def send_requests(model, instances):
+    """
+    Сериализует и отправляет инстансы одной модели подряд через один клиент.
+    Возвращает список ушедших PushRequest и словарь ошибок {pk: exception}
+    """
+    requests, errors = prepare_requests(model, instances)
+    client = instances[0].client
+    sent = []
+    for request in requests:
+        try:
+            model.crm_throttle()
+            response = client.request(request.method, request.action, request.data)
+            finish_request(request, response)
+            sent.append(request)
+        except Exception as err:
+            errors[request.instance.pk] = err
+    return sent, errors
+
+
+def push_instances(model, instances):
+    """
+    Пушит инстансы одной модели в crm. Запросы уходят подряд через один клиент,
+    каждая запись обрабатывается отдельно. Блокировки как у одиночного пуша:
+    без CRM_SYNC_SHORT_LOCK строки пачки заблокированы до ответа crm,
+    с ним запросы идут без блокировки.
+    Возвращает словарь ошибок {pk: exception} для неотправленных записей
+    """
+    errors = {}
+    if not instances:
+        return errors
+    if not is_batchable(model):
+        for instance in instances:
+            try:
+                model.crm_throttle()
+                instance.crm_push()
+            except Exception as err:
+                errors[instance.pk] = err
+        return errors
+    if get_setting('CRM_SYNC_SHORT_LOCK'):
+        sent, errors = send_requests(model, instances)
+        resync_changed(model, sent)
+    else:
+        with transaction.atomic():
+            pks = list(
+                model.get_queryset().filter(pk__in=[instance.pk for instance in instances])
+                .order_by('pk').select_for_update().values_list('pk', flat=True)
+            )
+            # перечитываем уже под блокировкой
+            instances = list(model.get_crm_push_queryset().filter(pk__in=pks))
+            if instances:
+                sent, errors = send_requests(model, instances)
+    for pk, err in errors.items():
+        if not isinstance(err, EspoAPIError):
+            logger.exception('crm push of %s %s failed', model.__name__, pk, exc_info=err)
+    return errors
@@ -0,0 +1,54 @@
+import logging
+from django.apps import apps
+
+
+logger = logging.getLogger(__name__)
+
+_models = {}
+
+
+def register(model):
+    """
+    Регистрирует модель crm под именем класса, которое передается в тасках синка
+    """
+    name = model.__name__
+    existing = _models.get(name)
+    if existing is not None and existing is not model:
+        logger.warning('crm model name %s is used by %s and %s', name,
+                       existing._meta.label, model._meta.label)
+    _models[name] = model
+
+
+def on_class_prepared(sender, **kwargs):
+    from crm.models import CRMSignalMixin
+    if issubclass(sender, CRMSignalMixin) and not sender._meta.abstract:
+        register(sender)
+
+
+def populate():
+    """
+    Добирает модели crm из реестра приложений. Вызывается из CrmConfig.ready()
+    """
+    from crm.models import CRMSignalMixin
+    for model in apps.get_models():
+        if issubclass(model, CRMSignalMixin):
+            register(model)
+
+
+def get_model(class_name):
+    """
+    Возвращает модель crm по имени класса
+    """
+    try:
+        return _models[class_name]
+    except KeyError:
+        populate()
+    try:
+        return _models[class_name]
+    except KeyError:
+        raise LookupError(f'{class_name} is not a registered crm model')
+
+
+def get_models():
+    populate()
+    return dict(_models)
@@ -1,16 +1,22 @@
+from collections import OrderedDict
 from rest_framework import serializers
-from django.core.exceptions import ObjectDoesNotExist
+from rest_framework.relations import MANY_RELATION_KWARGS
 from django.utils.translation import gettext_lazy as _
 from rest_framework.utils import model_meta
 from django.conf import settings
 from core.models import Address
 from api.gmaps import gmaps_client
 from rest_framework.settings import api_settings
+from crm.conf import get_setting
+from crm.geocoding import geocode
+from crm.push import forget_payload
 
 
 class CrmIdRelatedField(serializers.RelatedField):
     """
-    Аналог PkRelatedField по полю crm_id
+    Аналог PkRelatedField по полю crm_id.
+    Найденные объекты кладутся в context['crm_id_cache'], если он есть,
+    так что пачка сериализаторов с общим контекстом ищет каждую запись один раз
     """
     default_error_messages = {
         'required': _('This field is required.'),
@@ -18,16 +24,118 @@ class CrmIdRelatedField(serializers.RelatedField):
         'incorrect_type': _('Incorrect type. Expected pk value, received {data_type}.'),
     }
 
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+        return CrmIdManyRelatedField(**list_kwargs)
+
     def to_representation(self, value):
         return value.crm_id
 
+    def check_type(self, data):
+        if isinstance(data, bool) or not isinstance(data, (str, int)):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+    def resolve(self, crm_ids):
+        """
+        Ищет объекты по списку crm_id одним запросом. Отдает {crm_id: объект}
+        """
+        queryset = self.get_queryset()
+        # кэш общий для полей одной модели, поэтому только для querysets без фильтров
+        cache = self.context.get('crm_id_cache') if not queryset.query.where else None
+        label = queryset.model._meta.label
+        found, missing = {}, []
+        for crm_id in crm_ids:
+            if cache is not None and (label, crm_id) in cache:
+                found[crm_id] = cache[(label, crm_id)]
+            else:
+                missing.append(crm_id)
+        if missing:
+            for obj in queryset.filter(crm_id__in=missing):
+                found[obj.crm_id] = obj
+                if cache is not None:
+                    cache[(label, obj.crm_id)] = obj
+        return found
+
     def to_internal_value(self, data):
-        try:
-            return self.get_queryset().get(crm_id=data)
-        except ObjectDoesNotExist:
+        self.check_type(data)
+        obj = self.resolve([str(data)]).get(str(data))
+        if obj is None:
             self.fail('does_not_exist', crm_id_value=data)
-        except (TypeError, ValueError):
-            self.fail('incorrect_type', data_type=type(data).__name__)
+        return obj
+
+
+class CrmIdManyRelatedField(serializers.ManyRelatedField):
+    """
+    many=True для CrmIdRelatedField: все crm_id ищутся одним запросом,
+    ненайденные возвращаются одной ошибкой
+    """
+    default_error_messages = {
+        'does_not_exist': _('Invalid pks "{crm_id_values}" - objects do not exist.'),
+    }
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        for item in data:
+            self.child_relation.check_type(item)
+        crm_ids = [str(item) for item in data]
+        found = self.child_relation.resolve(list(OrderedDict.fromkeys(crm_ids)))
+        missing = [crm_id for crm_id in crm_ids if crm_id not in found]
+        if missing:
+            self.fail('does_not_exist', crm_id_values='", "'.join(missing))
+        return [found[crm_id] for crm_id in crm_ids]
+
+
+_address_components = {}
+
+
+def get_address_components(address):
+    """
+    Address.get_values_from_list по google place адреса. Разбор кэшируется в процессе
+    по google_place_id и formatted_address, так что обновленный place разбирается заново
+    """
+    key = (address.google_place_id, address.place.get('formatted_address'))
+    components = _address_components.get(key)
+    if components is None:
+        components = Address.get_values_from_list(address.place['address_components'])
+        if len(_address_components) >= get_setting('CRM_ADDRESS_COMPONENTS_CACHE_SIZE'):
+            _address_components.clear()
+        _address_components[key] = components
+    return components
+
+
+def get_address_representation(instance, ret):
+    """
+    Пишет адрес инстанса в ret полями shippingAddress* (формат адреса crm)
+    """
+    if instance.address.google_place_id:
+        address_dict = get_address_components(instance.address)
+        if address_dict.get('state'):
+            ret['shippingAddressState'] = address_dict['state']
+        else:
+            ret['shippingAddressState'] = address_dict.get('city')
+        ret['shippingAddressCity'] = address_dict.get('city')
+        if address_dict.get('building') and address_dict.get('street'):
+            ret['shippingAddressStreet'] = f'{address_dict["street"]}, {address_dict.get("building")}'
+        elif address_dict.get('street'):
+            ret['shippingAddressStreet'] = address_dict.get('street')
+        else:
+            ret['shippingAddressStreet'] = address_dict.get('city')
+    else:
+        ret['shippingAddressState'] = instance.address.state
+        if not instance.address.state:
+            ret['shippingAddressState'] = instance.address.city
+        ret['shippingAddressCity'] = instance.address.city
+        if instance.address.building and instance.address.street:
+            ret['shippingAddressStreet'] = f'{instance.address.street}, {instance.address.building}'
+        else:
+            ret['shippingAddressStreet'] = instance.address.street
 
 
 class CRMAddressSerializerMixin:
@@ -53,39 +161,53 @@ class CRMAddressSerializerMixin:
                 address_string = f'{state}, {city}, {street}'
             else:
                 address_string = f'{city}, {street}'
-            data['address'] = Address.get_address_from_string(address_string)
+            data['address'] = geocode(address_string)
         else:
-            data['address'] = Address.get_address_from_string('Russia, Moscow')
+            data['address'] = geocode('Russia, Moscow')
         return super().to_internal_value(data)
         
     def to_representation(self, instance):
         ret = super().to_representation(instance)
         if hasattr(instance, 'address'):
-            if instance.address.google_place_id:
-                address_dict = Address.get_values_from_list(instance.address.place['address_components'])
-                if address_dict.get('state'):
-                    ret['shippingAddressState'] = address_dict['state']
-                else:
-                    ret['shippingAddressState'] = address_dict.get('city')
-                ret['shippingAddressCity'] = address_dict.get('city')
-                if address_dict.get('building') and address_dict.get('street'):
-                    ret['shippingAddressStreet'] = f'{address_dict["street"]}, {address_dict.get("building")}'
-                elif address_dict.get('street'):
-                    ret['shippingAddressStreet'] = address_dict.get('street')
-                else:
-                    ret['shippingAddressStreet'] = address_dict.get('city')
-            else:
-                ret['shippingAddressState'] = instance.address.state
-                if not instance.address.state:
-                    ret['shippingAddressState'] = instance.address.city
-                ret['shippingAddressCity'] = instance.address.city
-                if instance.address.building and instance.address.street:
-                    ret['shippingAddressStreet'] = f'{instance.address.street}, {instance.address.building}'
-                else:
-                    ret['shippingAddressStreet'] = instance.address.street
+            get_address_representation(instance, ret)
         return ret
 
 
+class ModelFieldPlan:
+    """
+    Разбор полей модели для create/update сериализаторов crm.
+    Зависит только от класса модели, поэтому строится один раз (get_field_plan)
+    """
+    def __init__(self, model):
+        info = model_meta.get_field_info(model)
+        self.relations = info.relations
+        self.to_many = frozenset(
+            name for name, relation_info in info.relations.items() if relation_info.to_many
+        )
+
+    def split(self, validated_data):
+        """
+        Делит validated_data на атрибуты инстанса и to_many связи
+        """
+        attrs, many_to_many = {}, {}
+        for attr, value in validated_data.items():
+            if attr in self.to_many:
+                many_to_many[attr] = value
+            else:
+                attrs[attr] = value
+        return attrs, many_to_many
+
+
+_field_plans = {}
+
+
+def get_field_plan(model):
+    plan = _field_plans.get(model)
+    if plan is None:
+        plan = _field_plans[model] = ModelFieldPlan(model)
+    return plan
+
+
 class CRMSerializerMixin:  # TODO написать докстринги
     def create(self, validated_data):
         """
@@ -99,11 +221,7 @@ class CRMSerializerMixin:  # TODO написать докстринги
         # Remove many-to-many relationships from validated_data.
         # They are not valid arguments to the default `.create()` method,
         # as they require that the instance has already been saved.
-        info = model_meta.get_field_info(ModelClass)
-        many_to_many = {}
-        for field_name, relation_info in info.relations.items():
-            if relation_info.to_many and (field_name in validated_data):
-                many_to_many[field_name] = validated_data.pop(field_name)
+        validated_data, many_to_many = get_field_plan(ModelClass).split(validated_data)
 
         try:
             instance = ModelClass(**validated_data)
@@ -132,6 +250,7 @@ class CRMSerializerMixin:  # TODO написать докстринги
                 field = getattr(instance, field_name)
                 field.set(value)
 
+        forget_payload(instance)
         return instance
 
     def update(self, instance, validated_data):
@@ -140,28 +259,25 @@ class CRMSerializerMixin:  # TODO написать докстринги
         для передачи параметра dont_sync
         """
         serializers.raise_errors_on_nested_writes('update', self, validated_data)
-        info = model_meta.get_field_info(instance)
+        attrs, many_to_many = get_field_plan(instance.__class__).split(validated_data)
 
         # Simply set each attribute on the instance, and then save it.
         # Note that unlike `.create()` we don't need to treat many-to-many
         # relationships as being a special case. During updates we already
         # have an instance pk for the relationships to be associated with.
-        m2m_fields = []
-        for attr, value in validated_data.items():
-            if attr in info.relations and info.relations[attr].to_many:
-                m2m_fields.append((attr, value))
-            else:
-                setattr(instance, attr, value)
+        for attr, value in attrs.items():
+            setattr(instance, attr, value)
 
         instance.save(dont_sync=True)
 
         # Note that many-to-many fields are set after updating instance.
         # Setting m2m fields triggers signals which could potentially change
         # updated instance and we do not want it to collide with .update()
-        for attr, value in m2m_fields:
+        for attr, value in many_to_many.items():
             field = getattr(instance, attr)
             field.set(value)
 
+        forget_payload(instance)
         return instance
 
     def to_internal_value(self, data):
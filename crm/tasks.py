@@ -1,28 +1,125 @@
+from collections import OrderedDict
+from celery.utils.time import get_exponential_backoff_interval
 from petuni_main.celery import app
-from crm.models import CRMSignalMixin
-from api.espo_api_client import EspoAPIError
+from crm.registry import get_model
+from api.espo_api_client import EspoAPIError, EspoAPI404Error
+from crm.breaker import CRMCircuitOpenError
+from crm.dispatch import park, relay_outbox, release_sync
+from crm.push import push_instances
+from crm.client import get_client
+from crm.poll import poll
 
 
-def get_all_subclasses(class_):
-    result = {}
-    for subclass in class_.__subclasses__():
-        result[subclass.__name__] = subclass
-        result.update(get_all_subclasses(subclass))
-    return result
-
-SUBCLASSES = get_all_subclasses(CRMSignalMixin)
-
 @app.task(name='crm.crm_sync', autoretry_for=(EspoAPIError,), retry_backoff=True,
           retry_backoff_max=6000, max_retries=None)
 def crm_sync(class_name, instance_id):
-    sync_class = SUBCLASSES[class_name]
+    """
+    Пока crm недоступна (разомкнут предохранитель), синк не ретраится,
+    а откладывается в CRMOutbox
+    """
+    sync_class = get_model(class_name)
+    release_sync(class_name, instance_id)
     try:
-        instance = sync_class.get_queryset().get(pk=instance_id)
+        instance = sync_class.get_crm_push_queryset().get(pk=instance_id)
+        sync_class.crm_throttle()
         instance.crm_push()
     except sync_class.DoesNotExist:
         print(f'Instance of {sync_class.__name__} with pk {instance_id} does not exist')
+    except CRMCircuitOpenError:
+        park(syncs=[(class_name, instance_id)])
+
+@app.task(name='crm.crm_sync_batch', bind=True, max_retries=None)
+def crm_sync_batch(self, items):
+    """
+    Синк пачки записей. items - список пар (class_name, instance_id).
+    Записи группируются по классу, каждая группа грузится одним запросом
+    и сериализуется одним проходом. В ретрай уходят только записи,
+    упавшие с EspoAPIError, а при разомкнутом предохранителе они
+    откладываются в CRMOutbox.
+    """
+    groups = OrderedDict()
+    for class_name, instance_id in items:
+        release_sync(class_name, instance_id)
+        groups.setdefault(class_name, []).append(instance_id)
+    failed, parked = [], []
+    for class_name, ids in groups.items():
+        sync_class = get_model(class_name)
+        instances = list(sync_class.get_crm_push_queryset().filter(pk__in=ids))
+        errors = push_instances(sync_class, instances)
+        for pk, err in errors.items():
+            if isinstance(err, CRMCircuitOpenError):
+                parked.append((class_name, pk))
+            elif isinstance(err, EspoAPIError):
+                failed.append((class_name, pk))
+    if parked:
+        park(syncs=parked)
+    if failed:
+        countdown = get_exponential_backoff_interval(
+            factor=1, retries=self.request.retries, maximum=6000, full_jitter=True
+        )
+        raise self.retry(kwargs={'items': failed}, countdown=countdown)
 
 @app.task(name='crm.crm_sync_delete', autoretry_for=(EspoAPIError,), retry_backoff=True,
           retry_backoff_max=6000, max_retries=None)
-def crm_sync_delete(instance):
-    instance.crm_sync_delete()
+def crm_sync_delete(descriptor=None, instance=None):
+    """
+    Удаление записи в crm по описанию из CRMSignalMixin.get_crm_delete_descriptor.
+    instance - старый формат сообщения с целым инстансом, для тасок, уже лежащих в брокере.
+    Уже удаленная в crm запись (404) не ретраится, как в crm.crm_sync_delete_batch
+    """
+    if instance is not None:
+        descriptor = instance.get_crm_delete_descriptor()
+        if not descriptor['crm_id']:
+            return
+    action = f'{descriptor["crm_api_path"]}/{descriptor["crm_id"]}'
+    try:
+        get_client().request('DELETE', action, {})
+    except EspoAPI404Error:
+        pass
+    except CRMCircuitOpenError:
+        park(deletes=[descriptor])
+
+@app.task(name='crm.crm_sync_delete_batch', bind=True, max_retries=None)
+def crm_sync_delete_batch(self, descriptors):
+    """
+    Удаление пачки записей в crm (удаления одной транзакции, например каскадные).
+    Уже удаленные в crm записи (404) пропускаются, в ретрай уходят только
+    упавшие с EspoAPIError, а при разомкнутом предохранителе они
+    откладываются в CRMOutbox
+    """
+    client = get_client()
+    failed, parked = [], []
+    for descriptor in descriptors:
+        action = f'{descriptor["crm_api_path"]}/{descriptor["crm_id"]}'
+        try:
+            client.request('DELETE', action, {})
+        except EspoAPI404Error:
+            pass
+        except CRMCircuitOpenError:
+            parked.append(descriptor)
+        except EspoAPIError:
+            failed.append(descriptor)
+    if parked:
+        park(deletes=parked)
+    if failed:
+        countdown = get_exponential_backoff_interval(
+            factor=1, retries=self.request.retries, maximum=6000, full_jitter=True
+        )
+        raise self.retry(kwargs={'descriptors': failed}, countdown=countdown)
+
+@app.task(name='crm.crm_outbox_relay')
+def crm_outbox_relay():
+    """
+    Разбор CRMOutbox для запуска по расписанию, если отдельный релей не поднят.
+    Нужен и при CRM_SYNC_OUTBOX=False, если включен CRM_BREAKER_THRESHOLD:
+    туда паркуются синки, пока crm недоступна
+    """
+    while relay_outbox():
+        pass
+
+@app.task(name='crm.crm_poll')
+def crm_poll(entities=None):
+    """
+    Забирает изменения из crm поллером для запуска по расписанию
+    """
+    poll(entities)
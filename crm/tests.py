@@ -1,14 +1,22 @@
-from unittest.mock import patch
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
 from unittest import skip
-from django.test import TestCase, TransactionTestCase, override_settings
+from io import StringIO
+from types import SimpleNamespace
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from shelter.tests import ShelterCreationMixin, AdoptionPostCreationMixin
 from shelter.models import Shelter, AdoptionPost, ShelterPostComment
 import requests
-from auth.models import PetuniUser
+from api.espo_api_client import EspoAPIError, EspoAPI404Error
+from auth.models import PetuniUser, CRMPetuniUserSerializer
 from celery.exceptions import Retry
 from im.models import Message, Chat, ChatMembership, MessageCRMSyncSerializer
 from django.urls import reverse
+from django.core.management import call_command
 from django.contrib.auth.models import Permission
 from rest_framework.test import APIClient
 from im.tests import ChatCreateMixin
@@ -19,6 +27,29 @@ from api.fcm import pushes_outbox
 from clinic.tests import ClinicCreationMixin
 from clinic.models import Clinic
 import responses
+from crm.push import build_request, push_instances
+from crm.client import flatten_params, get_client
+from crm.dispatch import relay_outbox, send_deletes, send_syncs
+from crm.conf import get_cache
+from crm.throttle import EspoThrottle
+from crm.aio import (AsyncCRMEspoClient, AsyncCRMPusher, in_worker_thread,
+                     take_token as aio_take_token)
+import aiohttp
+from django.db.models.signals import post_delete
+from crm.breaker import (CRMCircuitOpenError, EspoCircuitBreaker, STATE_CLOSED,
+                         STATE_HALF_OPEN, STATE_OPEN)
+from crm.models import (CRM_DO_NOTHING, CRM_TRUE_DELETE, CRMGeocodeCache, CRMOutbox,
+                        CRMSyncCursor, crm_sync_delete)
+from crm.tasks import crm_sync_delete as crm_sync_delete_task
+from crm.geocoding import geocode, geocode_lru
+from crm.serializers import CrmIdRelatedField, get_address_components, get_field_plan
+from crm.fastpath import get_plan, serialize
+from crm.managers import CRMQuerySet
+from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from crm.poll import CRMPoller, poll
+from crm.views import CRMContactView
+from crm.registry import get_model
 from core.models import Pet
 from core.tests.mock_responses import *
 from core.tests.mixins import CountryMixin
@@ -32,12 +63,42 @@ class UndeleteAPIClient(APIClient):
         return self.generic('UNDELETE', path, data, content_type, **extra)
 
 
+class FakeAiohttpResponse:
+    """
+    Ответ aiohttp для тестов асинхронного клиента crm
+    """
+    def __init__(self, status, data=None):
+        self.status = status
+        self.data = data
+        self.headers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    async def read(self):
+        return b'' if self.data is None else b'{}'
+
+    async def json(self, content_type=None):
+        return self.data
+
+
+class FakeAiohttpSession(MagicMock):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
 class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
     @responses.activate
     @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw',
                        CRM_URL = 'https://aaa.com', CRM_SHELTER_CATEGORY='troll')
     def test_user_without_crm_id_shelter_save(self):
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -76,7 +137,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
 
         params = ('petuniId', 'firstName', 'phoneNumber', 'isActive', 'emailAddress', 'type')
 
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -90,7 +151,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             args, kwargs = request.call_args
             for param in params:
                 self.assertTrue(param in kwargs['json'])
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True            
@@ -102,6 +163,409 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             self.assertEqual(user.name, 'Wew')
             self.assertEqual(user.crm_id, 'pewpew')
     
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_repeated_saves_in_transaction_sync_once(self):
+        """
+        Несколько сохранений одной записи в транзакции дают один запрос в crm
+        """
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            with transaction.atomic():
+                user = PetuniUser.objects.create(
+                    name='Pew',
+                    email='www@fff.com',
+                    phone=70007654322
+                )
+                user.name = 'Wew'
+                user.save()
+                user.save()
+            user.refresh_from_db()
+            self.assertEqual(request.call_count, 1)
+            self.assertEqual(user.crm_id, 'pewpew')
+            args, kwargs = request.call_args
+            self.assertEqual(kwargs['json']['firstName'], 'Wew')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_sync_batch(self):
+        """
+        Записи, сохраненные в одной транзакции, уходят одной таской crm_sync_batch
+        """
+        ids = iter(('pewpew', 'pewpew2'))
+        with patch('requests.Session.request') as request, \
+                patch('crm.tasks.crm_sync_batch.retry') as retry:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': next(ids)}
+            request.return_value.content = True
+            with transaction.atomic():
+                user = PetuniUser.objects.create(
+                    name='Pew',
+                    email='www@fff.com',
+                    phone=70007654323
+                )
+                user2 = PetuniUser.objects.create(
+                    name='Wew',
+                    email='www2@fff.com',
+                    phone=70007654324
+                )
+            user.refresh_from_db()
+            user2.refresh_from_db()
+            self.assertEqual(request.call_count, 2)
+            self.assertEqual(user.crm_id, 'pewpew')
+            self.assertEqual(user2.crm_id, 'pewpew2')
+            retry.assert_not_called()
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_save_without_crm_changes_is_not_synced(self):
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654325
+            )
+        user = PetuniUser.objects.get(pk=user.pk)
+        with patch('requests.Session.request') as request, \
+                patch.object(PetuniUser, '_crm_tracked_attnames', frozenset({'name'}), create=True):
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            user.last_login = timezone.now()
+            user.save()
+            user.save(update_fields=['last_login'])
+            request.assert_not_called()
+            user.name = 'Wew'
+            user.save(update_fields=['last_login'])
+            request.assert_not_called()
+            user.save()
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'PATCH')
+
+    def test_resolve_crm_tracked_fields(self):
+        tracked = PetuniUser._resolve_crm_tracked_fields()
+        self.assertIsNotNone(tracked)
+        self.assertIn('name', tracked)
+
+        class PkSerializer(serializers.Serializer):
+            petuniId = serializers.IntegerField(source='pk')
+            firstName = serializers.CharField(source='name')
+
+        class DottedSerializer(PkSerializer):
+            lastName = serializers.CharField(source='name.upper')
+
+        with patch.object(PetuniUser, 'get_crm_serializer_class', return_value=PkSerializer):
+            self.assertEqual(PetuniUser._resolve_crm_tracked_fields(),
+                             frozenset({PetuniUser._meta.pk.attname, 'name'}))
+        with patch.object(PetuniUser, 'get_crm_serializer_class', return_value=DottedSerializer):
+            self.assertIsNone(PetuniUser._resolve_crm_tracked_fields())
+
+    def test_crm_saved_values_copy(self):
+        """
+        Копируются только изменяемые значения, остальные запоминаются как есть
+        """
+        user = PetuniUser(name='Pew')
+        user.tags = ['dog']
+        with patch.object(PetuniUser, '_crm_tracked_attnames',
+                          frozenset({'name', 'tags'}), create=True):
+            user.crm_remember_values()
+        self.assertIs(user._crm_saved_values['name'], user.name)
+        user.tags.append('cat')
+        self.assertEqual(user._crm_saved_values['tags'], ['dog'])
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_MINIMAL_PATCH=True,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_minimal_patch(self):
+        """
+        В PATCH уходят только изменившиеся поля, без изменений запрос не отправляется
+        """
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654326
+            )
+            user.refresh_from_db()
+            user.name = 'Wew'
+            user.save()
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'PATCH')
+            self.assertEqual(set(kwargs['json']), {'firstName', 'skipDuplicateCheck'})
+            self.assertEqual(kwargs['json']['firstName'], 'Wew')
+            request.reset_mock()
+            user.crm_push()
+            request.assert_not_called()
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_MINIMAL_PATCH=True,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_minimal_patch_after_pull(self):
+        """
+        Данные, пришедшие из crm, сбрасывают снимок: возврат к последнему
+        отправленному значению снова уходит в crm
+        """
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': '12345678901234599'}
+            request.return_value.content = True
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654326
+            )
+            user.refresh_from_db()
+            CRMContactView.get_pull_view().apply_data({
+                'id': '12345678901234599',
+                'petuniId': user.pk,
+                'firstName': 'Bob',
+                'isActive': True,
+                'phoneNumber': 70007654326,
+                'emailAddress': 'www@fff.com',
+            })
+            request.reset_mock()
+            user.refresh_from_db()
+            self.assertEqual(user.name, 'Bob')
+            user.name = 'Pew'
+            user.save()
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'PATCH')
+            self.assertEqual(kwargs['json']['firstName'], 'Pew')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_SHORT_LOCK=True)
+    def test_short_lock_push(self):
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654327
+            )
+            user.refresh_from_db()
+            self.assertEqual(user.crm_id, 'pewpew')
+            # crm_id уже записан параллельным пушем - созданный дубль удаляется из crm
+            PetuniUser.objects.filter(pk=user.pk).update(crm_id=None)
+            user.refresh_from_db()
+            request.return_value.json = lambda: {'id': 'pewpew2'}
+
+            def concurrent_build(instance, payload):
+                PetuniUser.objects.filter(pk=instance.pk).update(crm_id='pewpew')
+                return build_request(instance, payload)
+
+            with patch('crm.models.build_request', side_effect=concurrent_build):
+                user.crm_push()
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'DELETE')
+            self.assertIn('/pewpew2', kwargs['url'])
+            user.refresh_from_db()
+            self.assertEqual(user.crm_id, 'pewpew')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_async_pusher(self):
+        with override_settings(CRM_ENABLED=False):
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654330
+            )
+        session = FakeAiohttpSession()
+        session.request.return_value = FakeAiohttpResponse(200, {'id': 'pewpew'})
+        with patch('crm.aio.build_session', return_value=session):
+            self.assertEqual(AsyncCRMPusher(concurrency=2).run([('PetuniUser', user.pk)]), {})
+        args, kwargs = session.request.call_args
+        self.assertEqual(args[0], 'POST')
+        self.assertTrue(args[1].endswith(f'/api/v1/{PetuniUser.crm_api_path}'))
+        user.refresh_from_db()
+        self.assertEqual(user.crm_id, 'pewpew')
+        session.request.return_value = FakeAiohttpResponse(500)
+        user.name = 'Wew'
+        user.save(dont_sync=True)
+        errors = AsyncCRMPusher().run([('PetuniUser', user.pk)])
+        self.assertIsInstance(errors[('PetuniUser', user.pk)], EspoAPIError)
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_true_delete(self):
+        """
+        Удаление записи с CRM_TRUE_DELETE шлет DELETE <crm_api_path>/<crm_id>,
+        записи без crm_id пропускаются, в том числе в старом формате таски
+        """
+        with patch('requests.Session.request') as request, \
+                patch.object(PetuniUser, 'sync_delete', CRM_TRUE_DELETE):
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {}
+            request.return_value.content = True
+            crm_sync_delete(PetuniUser, PetuniUser(crm_id='pewpew'))
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'DELETE')
+            self.assertTrue(kwargs['url'].endswith(f'{PetuniUser.crm_api_path}/pewpew'))
+            request.reset_mock()
+            crm_sync_delete(PetuniUser, PetuniUser(crm_id=None))
+            request.assert_not_called()
+            crm_sync_delete_task(instance=PetuniUser(crm_id='legacy'))
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'DELETE')
+            self.assertTrue(kwargs['url'].endswith(f'{PetuniUser.crm_api_path}/legacy'))
+            request.reset_mock()
+            crm_sync_delete_task(instance=PetuniUser(crm_id=None))
+            request.assert_not_called()
+            request.return_value.status_code = 404 # уже удалена в crm - без ретрая
+            crm_sync_delete_task(descriptor=PetuniUser(crm_id='gone').get_crm_delete_descriptor())
+            self.assertEqual(request.call_count, 1)
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_SHORT_LOCK=True)
+    def test_push_of_deleted_row(self):
+        """
+        Запись удалили, пока шел POST: созданная в crm запись удаляется
+        только у моделей с CRM_TRUE_DELETE
+        """
+        for sync_delete, expected in ((CRM_DO_NOTHING, 'POST'), (CRM_TRUE_DELETE, 'DELETE')):
+            with override_settings(CRM_ENABLED=False):
+                user = PetuniUser.objects.create(
+                    name='Pew',
+                    email='www@fff.com',
+                    phone=70007654329
+                )
+
+            def respond(method, **kwargs):
+                if method == 'POST':
+                    PetuniUser.objects.filter(pk=user.pk).delete()
+                response = MagicMock(status_code=200, content=True)
+                response.json.return_value = {'id': 'orphan'}
+                return response
+
+            with patch('requests.Session.request', side_effect=respond) as request, \
+                    patch.object(PetuniUser, 'sync_delete', sync_delete):
+                self.assertEqual(push_instances(PetuniUser, [user]), {})
+                args, kwargs = request.call_args
+                self.assertEqual(args[0], expected)
+                if expected == 'DELETE':
+                    self.assertIn('/orphan', kwargs['url'])
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_SHORT_LOCK=True)
+    def test_push_resyncs_changed_row(self):
+        """
+        Запись изменилась, пока шел запрос без блокировки: планируется еще один синк
+        """
+        with override_settings(CRM_ENABLED=False):
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654331
+            )
+
+        def respond(method, **kwargs):
+            PetuniUser.objects.filter(pk=user.pk).update(name='Wew')
+            response = MagicMock(status_code=200, content=True)
+            response.json.return_value = {'id': 'pewpew'}
+            return response
+
+        with patch('requests.Session.request', side_effect=respond), \
+                patch('crm.push.schedule_syncs') as schedule:
+            self.assertEqual(push_instances(PetuniUser, [user]), {})
+            schedule.assert_called_once_with(PetuniUser, [user.pk])
+            schedule.reset_mock()
+            push_instances(PetuniUser, list(PetuniUser.objects.filter(pk=user.pk)))
+            schedule.assert_not_called()
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com')
+    def test_batch_push_locks_rows(self):
+        """
+        Без CRM_SYNC_SHORT_LOCK пачка, как и одиночный пуш, перечитывает строки
+        под блокировкой и отправляет их свежие данные
+        """
+        with override_settings(CRM_ENABLED=False):
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654332
+            )
+        PetuniUser.objects.filter(pk=user.pk).update(name='Wew')
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            self.assertEqual(push_instances(PetuniUser, [user]), {})
+            args, kwargs = request.call_args
+            self.assertEqual(kwargs['json']['firstName'], 'Wew')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='kekw', CRM_URL = 'https://aaa.com',
+                       CRM_SYNC_OUTBOX=True)
+    def test_outbox(self):
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            user = PetuniUser.objects.create(
+                name='Pew',
+                email='www@fff.com',
+                phone=70007654328
+            )
+            user.name = 'Wew'
+            user.save()
+            request.assert_not_called()
+            self.assertEqual(
+                CRMOutbox.objects.filter(class_name='PetuniUser', instance_id=str(user.pk)).count(), 2
+            )
+            self.assertEqual(relay_outbox(), 2)
+            self.assertEqual(request.call_count, 1)
+            self.assertFalse(CRMOutbox.objects.exists())
+            user.refresh_from_db()
+            self.assertEqual(user.crm_id, 'pewpew')
+
+    def test_outbox_bad_rows(self):
+        """
+        Строка неизвестной модели выкидывается, а не блокирует outbox,
+        откладываются только синки, упавшие с EspoAPIError
+        """
+        CRMOutbox.objects.create(class_name='RemovedModel', instance_id='1')
+        CRMOutbox.objects.create(class_name='PetuniUser', instance_id='1')
+        CRMOutbox.objects.create(class_name='PetuniUser', instance_id='2')
+        handler = lambda syncs, deletes: {
+            ('PetuniUser', '1'): EspoAPIError('crm is down'),
+            ('PetuniUser', '2'): ValueError('broken serializer'),
+        }
+        self.assertEqual(relay_outbox(handler=handler), 3)
+        row = CRMOutbox.objects.get()
+        self.assertEqual((row.class_name, row.instance_id), ('PetuniUser', '1'))
+        self.assertGreater(row.available_at, timezone.now())
+
+    def test_outbox_lease(self):
+        """
+        Строки удаляются только после handler, а если он упал - откладываются
+        """
+        CRMOutbox.objects.create(class_name='PetuniUser', instance_id='1')
+
+        def handler(syncs, deletes):
+            row = CRMOutbox.objects.get() # пока идет отправка, строка арендована
+            self.assertGreater(row.available_at, timezone.now())
+            raise RuntimeError('broker is down')
+
+        with self.assertRaises(RuntimeError):
+            relay_outbox(handler=handler)
+        self.assertGreater(CRMOutbox.objects.get().available_at, timezone.now())
+        self.assertEqual(relay_outbox(handler=lambda syncs, deletes: {}), 0)
+
+    @override_settings(CRM_OUTBOX_DRAIN_RATE=2)
+    def test_outbox_drain_rate(self):
+        """
+        Проход релея забирает не больше CRM_OUTBOX_DRAIN_RATE строк
+        """
+        for instance_id in range(5):
+            CRMOutbox.objects.create(class_name='PetuniUser', instance_id=str(instance_id))
+        handler = lambda syncs, deletes: {}
+        self.assertEqual(relay_outbox(handler=handler), 2)
+        self.assertEqual(CRMOutbox.objects.count(), 3)
+
     def address_asserts(self, kwargs):
         self.assertEqual(kwargs['json']['shippingAddressCity'], 'Moskva')
         self.assertEqual(kwargs['json']['shippingAddressStreet'], 'Krasnaya ploshad, 2')
@@ -113,7 +577,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
         params = ('shelterPetuniId', 'name', 'ownerId', 'ogrn', 'website', 'phoneNumber',
                 'description', 'legalName', 'shelterApprovalStatus','shippingAddressCity',
                  'shippingAddressState', 'shippingAddressStreet')
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew2'}
             request.return_value.content = True
@@ -129,7 +593,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             status=200,
             json=GMAPS_PLACE_RESPONSE
         )
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -151,7 +615,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             args, kwargs = request.call_args_list[0]
             for param in params:
                 self.assertTrue(param in kwargs['json'])
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -179,7 +643,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             status=200,
             json=GMAPS_PLACE_RESPONSE
         )
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -198,7 +662,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
             args, kwargs = request.call_args_list[0]
             for param in params:
                 self.assertTrue(param in kwargs['json'])
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -220,7 +684,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
         """
         В случае отличного от 200 кода ответа от crm celery повторяет задачу.
         """
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 409
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -230,7 +694,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
                     email='www@fff.com',
                     phone=70987654321
                 )            
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             def raise_exception():
                 raise requests.exceptions.Timeout
             request.side_effects = raise_exception
@@ -245,7 +709,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
     def test_save_message(self):
         chat = Chat.objects.create()
         params = ('post', 'parentType', 'parentId', 'type')
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -271,7 +735,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
                 chat=chat,
                 user=user
             )
-            with patch('requests.request') as request:
+            with patch('requests.Session.request') as request:
                 request.return_value.status_code = 200
                 request.return_value.json = lambda: {'id': 'pewpew3'}
                 request.return_value.content = True
@@ -287,7 +751,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
                 for param in params:
                     self.assertTrue(param in kwargs['json'])
             # Сообщуха от стаффа не должна синкаться
-            with patch('requests.request') as request:
+            with patch('requests.Session.request') as request:
                 request.return_value.status_code = 200
                 request.return_value.json = lambda: {'id': 'pewpew4'}
                 request.return_value.content = True
@@ -305,7 +769,7 @@ class CRMSyncTestCase(ShelterCreationMixin, TransactionTestCase):
                 chat=chat,
                 user=self.john
             )
-            with patch('requests.request') as request:
+            with patch('requests.Session.request') as request:
                 request.return_value.status_code = 200
                 request.return_value.json = lambda: {'id': 'pewpew5'}
                 request.return_value.content = True
@@ -334,7 +798,7 @@ class CRMReportsSyncTestCase(AdoptionPostCreationMixin, ChatCreateMixin, Transac
         params = ('created', 'reportedText', 'petuniId', 'reportAuthor',
                        'contentAuthor', 'objectType', 'objectId', 'objectText', 
                        'imageURLList')
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -357,7 +821,7 @@ class CRMReportsSyncTestCase(AdoptionPostCreationMixin, ChatCreateMixin, Transac
                              f'{self.adoption_post1.name}\n{self.adoption_post1.text}')
             self.assertEqual(kwargs['json']['objectType'], 'adoptionpost')
         #test image urls @ shelterpost
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew2'}
             request.return_value.content = True
@@ -378,7 +842,7 @@ class CRMReportsSyncTestCase(AdoptionPostCreationMixin, ChatCreateMixin, Transac
             )
 
         # test comment sync
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew3'}
             request.return_value.content = True
@@ -540,7 +1004,7 @@ class CRMContactViewTestCase(UsersCreationMixin, TestCase):
     @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
                        CRM_URL = 'https://aaa.com')
     def test_update(self):
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: self.response_data
             request.return_value.content = True
@@ -556,7 +1020,7 @@ class CRMContactViewTestCase(UsersCreationMixin, TestCase):
         self.response_data['id'] = '09876543211234567'
         self.response_data['petuniId'] = None
         users_count = PetuniUser.objects.count()
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: self.response_data
             request.return_value.content = True
@@ -565,10 +1029,122 @@ class CRMContactViewTestCase(UsersCreationMixin, TestCase):
             self.assertEqual(users_count + 1, PetuniUser.objects.count())
             self.assertTrue(PetuniUser.objects.filter(crm_id='09876543211234567').exists())
 
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
+                       CRM_URL = 'https://aaa.com')
+    def test_poll(self):
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'total': 1, 'list': [self.response_data]}
+            request.return_value.content = True
+            self.assertEqual(poll(['Contact']), {'Contact': 1})
+            self.assertEqual(request.call_args[1]['params'][0], ('orderBy', 'modifiedAt'))
+            self.bob.refresh_from_db()
+            self.assertEqual(self.bob.name, 'bobah')
+            self.assertEqual(CRMSyncCursor.get_value('poll:Contact'), '2020-10-20T05:50')
+            poll(['Contact'])
+            self.assertIn(('where[0][value]', '2020-10-20T05:50'),
+                          request.call_args[1]['params'])
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
+                       CRM_URL = 'https://aaa.com', CRM_API_USER_ID='api')
+    def test_poll_keyset_paging(self):
+        """
+        Запись, которой во время прохода подняли modifiedAt, не сдвигает
+        остальные записи мимо поллера
+        """
+        rows = {'a': '2020-01-01 00:00:01', 'b': '2020-01-01 00:00:02',
+                'c': '2020-01-01 00:00:03'}
+        applied = []
+
+        def fetch_page(poller, since, offset):
+            page = sorted(
+                ({'id': crm_id, 'modifiedAt': modified} for crm_id, modified in rows.items()
+                 if since is None or modified >= since),
+                key=lambda data: data['modifiedAt']
+            )[offset:offset + 2]
+            rows['a'] = '2020-01-01 00:00:04' # пуш поднял modifiedAt первой записи
+            return page
+
+        def apply_many(view, records):
+            applied.extend(data['id'] for data in records)
+            return {}
+
+        with patch.object(CRMPoller, 'fetch_page', fetch_page), \
+                patch.object(CRMContactView, 'apply_many', apply_many):
+            poll(['Contact'], page_size=2)
+        self.assertEqual(sorted(set(applied)), ['a', 'b', 'c'])
+        self.assertEqual(applied.count('b'), 1)
+        self.assertEqual(CRMSyncCursor.get_value('poll:Contact'), '2020-01-01 00:00:04')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
+                       CRM_URL = 'https://aaa.com', CRM_API_USER_ID='api')
+    def test_poll_skips_own_changes(self):
+        records = [
+            {'id': 'a', 'modifiedAt': '2020-01-01 00:00:01', 'modifiedById': 'api'},
+            {'id': 'b', 'modifiedAt': '2020-01-01 00:00:02', 'modifiedById': 'manager'},
+        ]
+        applied = []
+
+        def apply_many(view, records):
+            applied.extend(data['id'] for data in records)
+            return {}
+
+        with patch.object(CRMPoller, 'fetch_page', lambda poller, since, offset: records[offset:]), \
+                patch.object(CRMContactView, 'apply_many', apply_many):
+            self.assertEqual(poll(['Contact']), {'Contact': 1})
+        self.assertEqual(applied, ['b'])
+        self.assertEqual(CRMSyncCursor.get_value('poll:Contact'), '2020-01-01 00:00:02')
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
+                       CRM_URL = 'https://aaa.com')
+    def test_bulk_pull(self):
+        url = reverse('crm:contact-bulk-pull')
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'total': 1, 'list': [self.response_data]}
+            request.return_value.content = True
+            response = self.john_client.post(
+                url, {'ids': ['12345678901234567', '09876543211234567']}, format='json'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['12345678901234567'], {'status': 'ok'})
+            self.assertEqual(response.data['09876543211234567'], {'status': 'not_found'})
+            self.assertEqual(request.call_count, 2) # списочный GET и проверочный GET
+            self.bob.refresh_from_db()
+            self.assertEqual(self.bob.name, 'bobah')
+            response = self.john_client.post(url, {'ids': []}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
+                       CRM_URL = 'https://aaa.com')
+    def test_bulk_pull_confirms_missing(self):
+        """
+        Удаляется только запись, на которую одиночный GET ответил 404
+        """
+        url = reverse('crm:contact-bulk-pull')
+
+        def respond(method, url, **kwargs):
+            response = MagicMock(content=True, status_code=200)
+            response.json.return_value = {'total': 0, 'list': []}
+            if url.endswith('/12345678901234567'):
+                response.status_code = 404
+            return response
+
+        with patch('requests.Session.request', side_effect=respond), \
+                patch.object(CRMContactView, 'instance_perform_delete',
+                             return_value=True) as perform_delete:
+            response = self.john_client.post(
+                url, {'ids': ['12345678901234567', '09876543211234567']}, format='json'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['12345678901234567'], {'status': 'deleted'})
+            self.assertEqual(response.data['09876543211234567'], {'status': 'not_found'})
+            perform_delete.assert_called_once_with(self.bob)
+
     @override_settings(CRM_ENABLED=True, CRM_API_KEY='0f2b63a73779fb657cf56e266272955a',
                        CRM_URL = 'https://aaa.com')
     def test_delete_do_nothing(self):
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             bob_pk = self.bob.pk
             request.return_value.status_code = 404
             request.return_value.json = lambda: self.response_data
@@ -586,7 +1162,7 @@ class CRMShelterApproveViewTestCase(ShelterCreationMixin, TransactionTestCase):
 
     @responses.activate                   
     def test_permissions_and_request_methods(self):
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = 200
             request.return_value.json = lambda: {'id': 'pewpew'}
             request.return_value.content = True
@@ -736,7 +1312,7 @@ class CRMAccountPullViewTestCase(ShelterCreationMixin, CountryMixin, ClinicCreat
             status=200,
             json=place_resp
         )  
-        with patch('requests.request') as request:
+        with patch('requests.Session.request') as request:
             request.return_value.status_code = status_code
             request.return_value.json = lambda: response_data
             request.return_value.content = True
@@ -876,3 +1452,339 @@ class CRMAccountPullViewTestCase(ShelterCreationMixin, CountryMixin, ClinicCreat
         self.assertEqual(response.status_code, 204)
         self.assertFalse(Shelter.objects.filter(crm_id=self.account_crm_id).exists())
 
+
+class CRMEspoClientTestCase(SimpleTestCase):
+    def test_flatten_params(self):
+        params = {
+            'maxSize': 200,
+            'where': [{'type': 'after', 'attribute': 'modifiedAt', 'value': '2020-01-01 00:00:00'}],
+            'deleted': False,
+        }
+        self.assertEqual(flatten_params(params), [
+            ('maxSize', 200),
+            ('where[0][type]', 'after'),
+            ('where[0][attribute]', 'modifiedAt'),
+            ('where[0][value]', '2020-01-01 00:00:00'),
+            ('deleted', 'false'),
+        ])
+
+    @override_settings(CRM_URL='https://aaa.com', CRM_API_KEY='kekw')
+    def test_client_reuses_session(self):
+        with patch('requests.Session.request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json = lambda: {'id': 'pewpew'}
+            request.return_value.content = True
+            first = get_client()
+            second = get_client()
+            self.assertIs(first.session, second.session)
+            first.request('GET', 'Contact', {'maxSize': 1})
+            args, kwargs = request.call_args
+            self.assertEqual(args[0], 'GET')
+            self.assertEqual(kwargs['url'], 'https://aaa.com/api/v1/Contact')
+            self.assertEqual(kwargs['params'], [('maxSize', 1)])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CRMAsyncEspoClientTestCase(SimpleTestCase):
+    def request(self, session):
+        client = AsyncCRMEspoClient('https://aaa.com', 'kekw', session)
+        return asyncio.run(client.request('GET', 'Contact', {'maxSize': 1}))
+
+    def test_request(self):
+        session = MagicMock()
+        session.request.return_value = FakeAiohttpResponse(200, {'list': []})
+        self.assertEqual(self.request(session), {'list': []})
+        args, kwargs = session.request.call_args
+        self.assertEqual(args, ('GET', 'https://aaa.com/api/v1/Contact'))
+        self.assertEqual(kwargs['headers'], {'X-Api-Key': 'kekw'})
+        self.assertEqual(kwargs['params'], [('maxSize', '1')])
+
+    def test_errors(self):
+        session = MagicMock()
+        session.request.return_value = FakeAiohttpResponse(404)
+        with self.assertRaises(EspoAPI404Error):
+            self.request(session)
+        session.request.return_value = FakeAiohttpResponse(503)
+        with self.assertRaises(EspoAPIError):
+            self.request(session)
+        session.request.return_value = FakeAiohttpResponse(200)
+        with self.assertRaises(EspoAPIError): # пустой ответ
+            self.request(session)
+        session.request.side_effect = aiohttp.ClientConnectionError()
+        with self.assertRaises(EspoAPIError):
+            self.request(session)
+
+    def test_in_worker_thread(self):
+        with patch('crm.aio.close_old_connections') as close:
+            self.assertEqual(in_worker_thread(lambda: 1)(), 1)
+            self.assertEqual(close.call_count, 2)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                   CRM_BREAKER_THRESHOLD=2, CRM_BREAKER_HALF_OPEN_PROBES=1)
+class CRMCircuitBreakerTestCase(SimpleTestCase):
+    def test_open_half_open_close(self):
+        breaker = EspoCircuitBreaker('test')
+        breaker.record_failure()
+        breaker.check()
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), STATE_OPEN)
+        with self.assertRaises(CRMCircuitOpenError):
+            breaker.check()
+        with override_settings(CRM_BREAKER_COOLDOWN=0):
+            self.assertEqual(breaker.get_state(), STATE_HALF_OPEN)
+            breaker.check()
+            with self.assertRaises(CRMCircuitOpenError):
+                breaker.check()
+            breaker.record_failure()
+        self.assertEqual(breaker.get_state(), STATE_OPEN)
+        breaker.record_success()
+        self.assertEqual(breaker.get_state(), STATE_CLOSED)
+        breaker.check()
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CRMThrottleTestCase(SimpleTestCase):
+    @patch('crm.throttle.time.time', return_value=1000.5)
+    def test_take_token(self, now):
+        throttle = EspoThrottle('test-token')
+        self.assertEqual(throttle.try_token(rate=2), 0)
+        throttle.take_token(0, rate=2)
+        self.assertGreater(throttle.try_token(rate=2), 0)
+        with self.assertRaises(EspoAPIError):
+            throttle.take_token(0, rate=2)
+
+    @override_settings(CRM_CONCURRENCY_MAX=2)
+    def test_take_slot(self):
+        throttle = EspoThrottle('test-slot')
+        self.assertTrue(throttle.try_slot())
+        throttle.take_slot(0)
+        self.assertFalse(throttle.try_slot())
+        with self.assertRaises(EspoAPIError):
+            throttle.take_slot(0)
+        throttle.release_slot()
+        self.assertTrue(throttle.try_slot())
+
+    @override_settings(CRM_ADAPTIVE_CONCURRENCY=True, CRM_CONCURRENCY_MIN=1,
+                       CRM_CONCURRENCY_MAX=4, CRM_AIMD_DECREASE=0.5,
+                       CRM_AIMD_LATENCY_TARGET=1, CRM_AIMD_COOLDOWN=60)
+    def test_aimd(self):
+        throttle = EspoThrottle('test-aimd')
+        get_cache().set(throttle.get_key('limit'), 2, None)
+        throttle.release(0.1, False)
+        self.assertEqual(throttle.get_limit(), 2.5)
+        throttle.release(5, False) # медленный ответ лимит не растит
+        self.assertEqual(throttle.get_limit(), 2.5)
+        throttle.release(0.1, True)
+        self.assertEqual(throttle.get_limit(), 1.25)
+        throttle.release(0.1, True) # второй сброс только после CRM_AIMD_COOLDOWN
+        self.assertEqual(throttle.get_limit(), 1.25)
+        get_cache().delete(throttle.get_key('decreased'))
+        throttle.release(0.1, True)
+        self.assertEqual(throttle.get_limit(), 1)
+        get_cache().set(throttle.get_key('limit'), 4, None)
+        throttle.release(0.1, False)
+        self.assertEqual(throttle.get_limit(), 4)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_cache_without_keys(self):
+        """
+        На кэше, который не хранит ключи, лимиты не применяются, а не зацикливаются
+        """
+        throttle = EspoThrottle('test-dummy')
+        self.assertEqual(throttle.try_token(rate=1), 0)
+        self.assertTrue(throttle.try_slot())
+
+    def test_async_take_token(self):
+        """
+        Асинхронный пушер ждет токен в asyncio.sleep, а не в потоке executor
+        """
+        throttle = EspoThrottle('test-async')
+        with patch.object(throttle, 'try_token', side_effect=[0.5, 0]), \
+                patch('crm.aio.asyncio.sleep', new_callable=AsyncMock) as sleep:
+            asyncio.run(aio_take_token(throttle, time.time() + 10))
+        sleep.assert_awaited_once_with(0.5)
+
+
+class CRMDispatchTestCase(SimpleTestCase):
+    def test_send_syncs_routing(self):
+        with patch.object(PetuniUser, 'crm_queue', 'crm_contacts'), \
+                patch.object(PetuniUser, 'crm_priority', 9), \
+                patch('crm.dispatch.app.signature') as signature:
+            send_syncs([('PetuniUser', 1), ('Shelter', 3), ('PetuniUser', 2)])
+            names = [args[0] for args, kwargs in signature.call_args_list]
+            self.assertEqual(names, ['crm.crm_sync_batch', 'crm.crm_sync'])
+            self.assertEqual(signature.call_args_list[0][1]['kwargs']['items'],
+                             [('PetuniUser', 1), ('PetuniUser', 2)])
+            calls = signature.return_value.apply_async.call_args_list
+            self.assertEqual(calls[0][1], {'queue': 'crm_contacts', 'priority': 9})
+            self.assertEqual(calls[1][1], {})
+
+
+    def test_send_deletes_batch(self):
+        descriptors = [
+            {'class_name': 'Shelter', 'crm_id': f'{i:017d}', 'crm_api_path': 'Account'}
+            for i in range(3)
+        ]
+        with patch('crm.dispatch.app.signature') as signature:
+            send_deletes(descriptors)
+            signature.assert_called_once_with('crm.crm_sync_delete_batch',
+                                              kwargs={'descriptors': descriptors})
+            signature.reset_mock()
+            send_deletes(descriptors[:1])
+            signature.assert_called_once_with('crm.crm_sync_delete',
+                                              kwargs={'descriptor': descriptors[0]})
+            self.assertEqual(signature.return_value.apply_async.call_args[1], {'producer': None})
+
+    def test_delete_receiver_connected_per_model(self):
+        self.assertIn(crm_sync_delete, post_delete._live_receivers(Shelter))
+        self.assertNotIn(crm_sync_delete, post_delete._live_receivers(Permission))
+
+class CRMRegistryTestCase(SimpleTestCase):
+    def test_get_model(self):
+        self.assertIs(get_model('PetuniUser'), PetuniUser)
+        self.assertIs(get_model('Shelter'), Shelter)
+        with self.assertRaises(LookupError):
+            get_model('CRMOutbox')
+
+
+@override_settings(CRM_GEOCODE_CACHE=True)
+class CRMGeocodeCacheTestCase(TestCase):
+    def setUp(self):
+        geocode_lru.clear()
+
+    def test_geocode_cache(self):
+        with patch('crm.geocoding.Address.get_address_from_string') as get_address:
+            get_address.return_value = {'google_place_id': 'abc'}
+            self.assertEqual(geocode('Москва,  Москва, Солнцевский проспект'), {'google_place_id': 'abc'})
+            self.assertEqual(geocode('москва, москва,солнцевский проспект'), {'google_place_id': 'abc'})
+            self.assertEqual(get_address.call_count, 1)
+            geocode_lru.clear()
+            self.assertEqual(geocode('Москва, Москва, Солнцевский проспект'), {'google_place_id': 'abc'})
+            self.assertEqual(get_address.call_count, 1)
+
+    def test_negative_geocode_cache(self):
+        with patch('crm.geocoding.Address.get_address_from_string') as get_address:
+            get_address.side_effect = ValidationError('ZERO_RESULTS')
+            for i in range(2):
+                with self.assertRaises(ValidationError):
+                    geocode('Нигде, нигде')
+            self.assertEqual(get_address.call_count, 1)
+            self.assertTrue(CRMGeocodeCache.objects.get().negative)
+
+    def test_geocode_errors_are_not_cached(self):
+        with patch('crm.geocoding.Address.get_address_from_string') as get_address:
+            get_address.side_effect = ValidationError('OVER_QUERY_LIMIT')
+            for i in range(2):
+                with self.assertRaises(ValidationError):
+                    geocode('Москва, Москва, Солнцевский проспект')
+            self.assertEqual(get_address.call_count, 2)
+            self.assertFalse(CRMGeocodeCache.objects.exists())
+
+
+class CRMAddressComponentsTestCase(SimpleTestCase):
+    def test_components_parsed_once_per_place(self):
+        address = SimpleNamespace(google_place_id='place', place={
+            'formatted_address': 'Moskva', 'address_components': [],
+        })
+        with patch('crm.serializers.Address.get_values_from_list') as get_values:
+            get_values.return_value = {'city': 'Moskva'}
+            self.assertEqual(get_address_components(address), {'city': 'Moskva'})
+            self.assertEqual(get_address_components(address), {'city': 'Moskva'})
+            self.assertEqual(get_values.call_count, 1)
+            address.place = {'formatted_address': 'Moskva, Tverskaya', 'address_components': []}
+            get_address_components(address)
+            self.assertEqual(get_values.call_count, 2)
+
+
+class CRMCrmIdRelatedFieldTestCase(UsersCreationMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.bob.crm_id = '12345678901234567'
+        self.bob.save(dont_sync=True)
+        self.john.crm_id = '12345678901234568'
+        self.john.save(dont_sync=True)
+
+    def test_many_resolved_in_one_query(self):
+        field = CrmIdRelatedField(many=True, queryset=PetuniUser.objects.all())
+        field.bind('users', serializers.Serializer(context={'crm_id_cache': {}}))
+        with self.assertNumQueries(1):
+            users = field.to_internal_value(['12345678901234567', '12345678901234568',
+                                             '12345678901234567'])
+        self.assertEqual([user.pk for user in users], [self.bob.pk, self.john.pk, self.bob.pk])
+        with self.assertNumQueries(0):
+            field.to_internal_value(['12345678901234568'])
+        with self.assertRaises(serializers.ValidationError) as err:
+            field.to_internal_value(['12345678901234567', 'aaaaaaaaaaaaaaaaa', 'bbbbbbbbbbbbbbbbb'])
+        self.assertIn('aaaaaaaaaaaaaaaaa", "bbbbbbbbbbbbbbbbb', str(err.exception.detail))
+
+
+@override_settings(CRM_SYNC_FASTPATH=True, CRM_SYNC_FASTPATH_VERIFY=True)
+class CRMFastpathTestCase(UsersCreationMixin, TestCase):
+    def test_plan_matches_drf(self):
+        users = list(PetuniUser.objects.all())
+        plan = get_plan(CRMPetuniUserSerializer)
+        self.assertIsNotNone(plan)
+        self.assertEqual(serialize(CRMPetuniUserSerializer, users),
+                         [dict(CRMPetuniUserSerializer(user).data) for user in users])
+        self.assertIs(get_plan(CRMPetuniUserSerializer), plan)
+
+
+class CRMFieldPlanTestCase(SimpleTestCase):
+    def test_field_plan_cached_per_model(self):
+        plan = get_field_plan(PetuniUser)
+        self.assertIs(get_field_plan(PetuniUser), plan)
+        attrs, many_to_many = plan.split({'name': 'bob', 'groups': []})
+        self.assertEqual(attrs, {'name': 'bob'})
+        self.assertEqual(many_to_many, {'groups': []})
+
+
+@override_settings(CRM_ENABLED=True)
+class CRMQuerySetTestCase(UsersCreationMixin, TestCase):
+    def test_bulk_update_schedules_one_batch(self):
+        queryset = CRMQuerySet(model=PetuniUser)
+        with patch('crm.managers.schedule_syncs') as schedule:
+            queryset.filter(pk=self.bob.pk).update(name='bobah')
+            schedule.assert_called_once_with(PetuniUser, [self.bob.pk], using='default')
+            schedule.reset_mock()
+            users = list(queryset.filter(pk__in=[self.bob.pk, self.john.pk]).order_by('pk'))
+            users[0].name = 'changed'
+            queryset.bulk_update(users, ['name'])
+            schedule.assert_called_once_with(PetuniUser, [users[0].pk], using='default')
+            schedule.reset_mock()
+            queryset.without_crm_sync().filter(pk=self.bob.pk).update(name='bob')
+            schedule.assert_not_called()
+
+
+class CRMBackfillTestCase(UsersCreationMixin, TestCase):
+    def backfill(self, *args, crash_on=None):
+        chunks = []
+
+        def run_instances(pusher, model, instances):
+            if len(chunks) == crash_on:
+                raise KeyboardInterrupt
+            chunks.append([instance.pk for instance in instances])
+            if len(chunks) == 1: # первая запись первой пачки не ушла
+                return {instances[0].pk: EspoAPIError('crm is down')}
+            return {}
+
+        with patch.object(AsyncCRMPusher, 'run_instances', autospec=True,
+                          side_effect=run_instances):
+            try:
+                call_command('crm_backfill', 'PetuniUser', '--chunk-size=1', *args,
+                             stdout=StringIO())
+            except KeyboardInterrupt:
+                pass
+        return chunks
+
+    def test_backfill_resume_and_reset(self):
+        pks = list(PetuniUser.get_crm_push_queryset().order_by('pk').values_list('pk', flat=True))
+        self.assertEqual(self.backfill(crash_on=1), [[pks[0]]])
+        self.assertEqual(CRMSyncCursor.get_value('backfill:PetuniUser'), str(pks[0]))
+        row = CRMOutbox.objects.get()
+        self.assertEqual((row.class_name, row.instance_id), ('PetuniUser', str(pks[0])))
+        self.assertEqual(self.backfill(), [[pk] for pk in pks[1:]])
+        self.assertIsNone(CRMSyncCursor.get_value('backfill:PetuniUser'))
+        self.assertEqual(self.backfill(), [[pk] for pk in pks])
+        CRMSyncCursor.set_value('backfill:PetuniUser', str(pks[-1]))
+        self.assertEqual(self.backfill('--reset'), [[pk] for pk in pks])
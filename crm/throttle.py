@@ -0,0 +1,143 @@
+import logging
+import random
+import time
+from api.espo_api_client import EspoAPIError
+from crm.conf import get_cache, get_setting
+
+
+logger = logging.getLogger(__name__)
+
+# Сколько раз пересоздать истекший между add и incr ключ. Если кэш ключи
+# не хранит (DummyCache), после этого лимит не применяется
+CACHE_RETRIES = 3
+
+
+class EspoThrottle:
+    """
+    Общее для всех процессов ограничение нагрузки на crm, состояние лежит в кэше CRM_CACHE.
+    - CRM_RATE_LIMIT: не больше N запросов в секунду (ведро токенов, пополняемое раз в секунду)
+    - CRM_ADAPTIVE_CONCURRENCY: AIMD-лимит одновременных запросов. Лимит делится на
+      CRM_AIMD_DECREASE при 429/5xx/таймаутах и растет на 1 за каждые limit успешных
+      запросов, пока задержка не выше CRM_AIMD_LATENCY_TARGET
+    """
+    def __init__(self, name='espo'):
+        self.name = name
+
+    def get_key(self, suffix):
+        return f'crm:throttle:{self.name}:{suffix}'
+
+    def get_backoff(self, attempt):
+        return min(0.05 * 2 ** attempt, 1) * random.uniform(0.5, 1.5)
+
+    def wait(self, attempt):
+        time.sleep(self.get_backoff(attempt))
+
+    def try_token(self, rate=None):
+        """
+        Берет токен без ожидания. Отдает 0, если взял, иначе сколько ждать нового окна, сек.
+        """
+        rate = rate or get_setting('CRM_RATE_LIMIT')
+        if not rate:
+            return 0
+        cache = get_cache()
+        for attempt in range(CACHE_RETRIES):
+            now = time.time()
+            key = self.get_key(f'rate:{int(now)}')
+            cache.add(key, 0, 2)
+            try:
+                if cache.incr(key) <= rate:
+                    return 0
+            except ValueError: # ключ истек между add и incr
+                continue
+            return int(now) + 1 - now + random.uniform(0, 0.05)
+        logger.warning('crm throttle %s: cache does not keep keys, rate limit skipped', self.name)
+        return 0
+
+    def take_token(self, deadline, rate=None):
+        rate = rate or get_setting('CRM_RATE_LIMIT')
+        while True:
+            delay = self.try_token(rate)
+            if not delay:
+                return
+            if time.time() > deadline:
+                raise EspoAPIError(f'crm rate limit {rate}/s exceeded for {self.name}')
+            time.sleep(delay)
+
+    def get_limit(self):
+        limit = get_cache().get(self.get_key('limit'))
+        if limit is None:
+            return float(get_setting('CRM_CONCURRENCY_MAX'))
+        return limit
+
+    def try_slot(self):
+        """
+        Занимает слот конкурентности без ожидания. Отдает True, если занял
+        """
+        cache = get_cache()
+        key = self.get_key('inflight')
+        for attempt in range(CACHE_RETRIES):
+            cache.add(key, 0, get_setting('CRM_THROTTLE_STATE_TTL'))
+            try:
+                inflight = cache.incr(key)
+            except ValueError:
+                continue
+            if inflight <= max(int(self.get_limit()), 1):
+                return True
+            self.release_slot()
+            return False
+        logger.warning('crm throttle %s: cache does not keep keys, concurrency limit skipped',
+                       self.name)
+        return True
+
+    def take_slot(self, deadline):
+        attempt = 0
+        while not self.try_slot():
+            if time.time() > deadline:
+                raise EspoAPIError(f'crm concurrency limit exceeded for {self.name}')
+            self.wait(attempt)
+            attempt += 1
+
+    def release_slot(self):
+        cache = get_cache()
+        key = self.get_key('inflight')
+        try:
+            if cache.decr(key) < 0:
+                cache.set(key, 0, get_setting('CRM_THROTTLE_STATE_TTL'))
+        except ValueError: # состояние истекло, счетчик начат заново
+            pass
+
+    def acquire(self):
+        """
+        Ждет разрешения на запрос. Если не дождались за CRM_THROTTLE_WAIT, кидает EspoAPIError
+        """
+        deadline = time.time() + get_setting('CRM_THROTTLE_WAIT')
+        self.take_token(deadline)
+        if get_setting('CRM_ADAPTIVE_CONCURRENCY'):
+            self.take_slot(deadline)
+
+    def release(self, latency, overloaded):
+        """
+        Отпускает слот и подстраивает лимит конкурентности под ответ crm
+        """
+        if not get_setting('CRM_ADAPTIVE_CONCURRENCY'):
+            return
+        self.release_slot()
+        cache = get_cache()
+        limit = self.get_limit()
+        if overloaded:
+            # один сброс лимита на волну ошибок, а не на каждый упавший запрос
+            if not cache.add(self.get_key('decreased'), 1, get_setting('CRM_AIMD_COOLDOWN')):
+                return
+            limit = max(limit * get_setting('CRM_AIMD_DECREASE'), get_setting('CRM_CONCURRENCY_MIN'))
+        elif latency <= get_setting('CRM_AIMD_LATENCY_TARGET'):
+            limit = min(limit + 1 / limit, get_setting('CRM_CONCURRENCY_MAX'))
+        else:
+            return
+        cache.set(self.get_key('limit'), limit, None)
+
+
+espo_throttle = EspoThrottle()
+
+
+def is_overload_status(status_code):
+    return status_code == 429 or status_code >= 500
@@ -1,5 +1,9 @@
 from django.urls import path, re_path, register_converter
-from .views import *
+from .views import (CRMContactView, CRMAccountPullView, CRMAccountScheduleView,
+                    CRMClinicServiceOfferView, CRMPetuniUserView, CRMPetuniUserWarnView,
+                    CRMShelterApproveView, CRMPostView, CRMCommentView, CRMPetDeleteView,
+                    CRMContactBulkPullView, CRMAccountScheduleBulkPullView,
+                    CRMClinicServiceOfferBulkPullView)
 from core.routers import PetuniRouter
 from .converters import CRMIdConverter
 
@@ -15,6 +19,11 @@ urlpatterns = [
          name='account_schedule'),
     path('clinic-service-offer/<crmid:crm_id>/pull/', CRMClinicServiceOfferView.as_view(),
          name='clinic_service_offer'),
+    path('contact/bulk-pull/', CRMContactBulkPullView.as_view(), name='contact-bulk-pull'),
+    path('account-schedule/bulk-pull/', CRMAccountScheduleBulkPullView.as_view(),
+         name='account_schedule-bulk-pull'),
+    path('clinic-service-offer/bulk-pull/', CRMClinicServiceOfferBulkPullView.as_view(),
+         name='clinic_service_offer-bulk-pull'),
     path('user/<uuid:pk>/', CRMPetuniUserView.as_view(), name='user-detail'),
     path('user/<uuid:pk>/warn/', CRMPetuniUserWarnView.as_view(), name='user-warn'),
     re_path(r'shelter/(?P<pk>[0-9a-f-]+)/registration-request-(?P<action>(approve)|(reject))/$',
@@ -17,7 +17,11 @@ from social.models import Post, Comment, ClinicReview
 from shelter.serializers.comment import ShelterPostCommentSerializer
 from shelter.models import CRMShelterSerializer #TODO delete from shelter.serializers
 from django.utils.translation import ugettext_lazy as _
-from api.espo_api_client import EspoClientMixin, EspoAPI404Error, EspoAPIError
+from api.espo_api_client import EspoAPI404Error, EspoAPIError
+from crm.client import CRMEspoClientMixin
+from crm.conf import get_setting
+from crm.push import forget_payload
+from rest_framework.exceptions import ValidationError
 from shops.utils import get_object_or_none
 from django.conf import settings
 from rest_framework import status
@@ -26,8 +30,12 @@ from clinic.serializers import CRMClinicScheduleSerializer, CRMServiceOfferSeria
 from clinic.serializers import CRMClinicSerializer
 from django.http import Http404
 from notification.models import Notification
-from django.db import IntegrityError
-from django.core.exceptions import SuspiciousOperation, ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from django.utils.decorators import method_decorator
+from django.core.exceptions import SuspiciousOperation
 
 
 class UndestroyMixin():
@@ -49,10 +57,50 @@ class CRMSyncGenericView(UndeleteModelMixin, generics.RetrieveUpdateDestroyAPIVi
     http_method_names = ['get', 'post', 'patch', 'put', 'delete', 'undelete']
 
 
-class CRMBaseView(EspoClientMixin, generics.GenericAPIView):
+class CRMPullViewMixin():
+    @classmethod
+    def get_pull_view(cls, **kwargs):
+        """
+        Инстанс вьюхи для синка из crm без http-запроса (поллер, пачечный пулл)
+        """
+        view = cls(**kwargs)
+        view.request = None
+        view.args = ()
+        view.kwargs = {}
+        view.format_kwarg = None
+        return view
+
+    @staticmethod
+    def get_row_state(instance):
+        return [getattr(instance, field.attname) for field in instance._meta.concrete_fields]
+
+    def save_validated(self, serializer, locked, revalidate):
+        """
+        Пишет данные, провалидированные до блокировки строки. Если строка изменилась
+        с момента валидации, данные валидируются заново на заблокированной строке
+        """
+        instance = serializer.instance
+        if (locked is None) != (instance is None) or (
+                locked is not None and self.get_row_state(locked) != self.get_row_state(instance)):
+            serializer = revalidate(locked)
+        else:
+            serializer.instance = locked
+        serializer.save()
+        forget_payload(serializer.instance)
+        return serializer
+
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class CRMBaseView(CRMPullViewMixin, CRMEspoClientMixin, generics.GenericAPIView):
     permission_classes = [CRMEnabledAndIsAdminPermissions]
     http_method_names = ['post']
     lookup_field = 'crm_id'
+    crm_id_cache = None # общий для пачки кэш объектов CrmIdRelatedField
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['crm_id_cache'] = self.crm_id_cache
+        return context
 
     def get_object(self):
         """
@@ -83,39 +131,123 @@ class CRMBaseView(EspoClientMixin, generics.GenericAPIView):
         instance.delete()
         return True
 
-    def save_via_pk(self, data):
+    def find_instance(self, data, queryset):
         """
-        Сохраняет объект по pk
+        Запись для данных из crm: по petuniId, иначе по crm_id
         """
         pk = data.get('petuniId')
-        queryset = self.get_queryset()
-        try:
-            instance = queryset.get(pk=pk)
+        if pk:
+            instance = queryset.filter(pk=pk).first()
+            if instance is not None:
+                return instance
+        return queryset.filter(crm_id=data['id']).first()
+
+    def validate_data(self, data, instance=None):
+        if instance is not None:
             serializer = self.get_serializer(instance, data)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-            return serializer
-        except ObjectDoesNotExist:
-            return None
- 
+        else:
+            serializer = self.get_serializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def prepare_data(self, data):
+        """
+        Валидирует запись из crm без блокировок (валидация может ходить в gmaps)
+        """
+        instance = self.find_instance(data, self.filter_queryset(self.get_queryset()))
+        return self.validate_data(data, instance)
+
+    def save_data(self, data, serializer, locked):
+        return self.save_validated(
+            serializer, locked, lambda instance: self.validate_data(data, instance)
+        )
+
+    def lock_instance(self, data, instance):
+        queryset = self.filter_queryset(self.get_queryset()).select_for_update()
+        if instance is not None:
+            locked = queryset.filter(pk=instance.pk).first()
+            if locked is not None:
+                return locked
+        return self.find_instance(data, queryset)
+
+    def apply_data(self, data):
+        """
+        Сохраняет запись из crm, блокируя строку только на время записи
+        """
+        serializer = self.prepare_data(data)
+        with transaction.atomic():
+            locked = self.lock_instance(data, serializer.instance)
+            return self.save_data(data, serializer, locked)
+
+    def lock_instances(self, crm_ids, pks=()):
+        """
+        Блокирует и отдает локальные записи по списку crm_id (и pk) одним запросом.
+        Отдает {crm_id: instance}, {pk: instance}
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.filter(Q(crm_id__in=crm_ids) | Q(pk__in=pks))
+        by_crm_id, by_pk = {}, {}
+        for instance in queryset.order_by('pk').select_for_update():
+            by_pk[instance.pk] = instance
+            if instance.crm_id:
+                by_crm_id[instance.crm_id] = instance
+        return by_crm_id, by_pk
+
+    def apply_many(self, records):
+        """
+        Сохраняет пачку записей из crm. Валидация идет без блокировок,
+        запись - одной транзакцией, каждая запись в своем savepoint.
+        Возвращает {crm_id: serializer или исключение}
+        """
+        self.crm_id_cache = {}
+        try:
+            return self._apply_many(records)
+        finally:
+            self.crm_id_cache = None
+
+    def _apply_many(self, records):
+        results = OrderedDict()
+        prepared = []
+        for data in records:
+            try:
+                prepared.append((data, self.prepare_data(data)))
+            except Exception as err:
+                results[data['id']] = err
+        if not prepared:
+            return results
+        pks = [serializer.instance.pk for data, serializer in prepared
+               if serializer.instance is not None]
+        with transaction.atomic():
+            by_crm_id, by_pk = self.lock_instances([data['id'] for data, serializer in prepared], pks)
+            for data, serializer in prepared:
+                instance = serializer.instance
+                locked = by_pk.get(instance.pk) if instance is not None else None
+                if locked is None:
+                    locked = by_crm_id.get(data['id'])
+                try:
+                    with transaction.atomic():
+                        results[data['id']] = self.save_data(data, serializer, locked)
+                except Exception as err:
+                    results[data['id']] = err
+        return OrderedDict((data['id'], results[data['id']]) for data in records)
+
     def post(self, request, *args, **kwargs):
-        instance = self.get_object()
         action = f'{self.serializer_class.Meta.model.crm_api_path}/{kwargs["crm_id"]}'
         try:
             data = self.client.request('GET', action=action)
-            serializer = self.save_via_pk(data)
-            if serializer is None:
-                if instance is not None:
-                    serializer = self.get_serializer(instance, data)
-                else:
-                    serializer = self.get_serializer(data=data)
-                serializer.is_valid(raise_exception=True)
-                serializer.save()
+            serializer = self.prepare_data(data)
+            self.check_object_permissions(request, serializer.instance)
+            # строку блокируем только на время записи, не на время запроса в crm и валидации
+            with transaction.atomic():
+                locked = self.lock_instance(data, serializer.instance)
+                serializer = self.save_data(data, serializer, locked)
             return Response(serializer.data, status=status.HTTP_200_OK)
         except EspoAPI404Error: # if status code 404 delete the instance
-            if instance is not None:
-                if self.instance_perform_delete(instance):
-                    return Response(status=status.HTTP_204_NO_CONTENT)
+            with transaction.atomic():
+                instance = self.get_object()
+                if instance is not None:
+                    if self.instance_perform_delete(instance):
+                        return Response(status=status.HTTP_204_NO_CONTENT)
             return Response(status=status.HTTP_200_OK)
         except Exception as err:
             self.client.request('PATCH', action=action,
@@ -123,6 +255,89 @@ class CRMBaseView(EspoClientMixin, generics.GenericAPIView):
             raise err
 
 
+class CRMBulkPullMixin():
+    """
+    Пачечный пулл для наследников CRMBaseView: POST {"ids": [crm_id, ...]}.
+    Записи забираются из crm списочными запросами, локальные строки
+    блокируются одним запросом, все сохраняется одной транзакцией
+    с результатом по каждому crm_id
+    """
+    def get_crm_ids(self, request):
+        crm_ids = request.data.get('ids')
+        if (not isinstance(crm_ids, list) or not crm_ids
+                or not all(isinstance(crm_id, str) for crm_id in crm_ids)):
+            raise ValidationError({'ids': _('list of crm ids is required')})
+        if len(crm_ids) > get_setting('CRM_BULK_PULL_MAX_IDS'):
+            raise ValidationError({'ids': _('too many crm ids')})
+        return list(OrderedDict.fromkeys(crm_ids))
+
+    def fetch_records(self, crm_ids):
+        entity = self.serializer_class.Meta.model.crm_api_path
+        page_size = get_setting('CRM_POLL_PAGE_SIZE')
+        records = []
+        for start in range(0, len(crm_ids), page_size):
+            chunk = crm_ids[start:start + page_size]
+            params = {
+                'maxSize': len(chunk),
+                'where': [{'type': 'in', 'attribute': 'id', 'value': chunk}],
+            }
+            records.extend(self.client.request('GET', entity, params)['list'])
+        return records
+
+    def confirm_missing(self, crm_ids):
+        """
+        Списочный запрос мог не вернуть запись не только из-за удаления
+        (права, фильтры crm), поэтому каждое отсутствие подтверждаем
+        одиночным GET. Отдает crm_id, на которые crm ответила 404
+        """
+        entity = self.serializer_class.Meta.model.crm_api_path
+        confirmed = []
+        for crm_id in crm_ids:
+            try:
+                self.client.request('GET', action=f'{entity}/{crm_id}')
+            except EspoAPI404Error:
+                confirmed.append(crm_id)
+            except EspoAPIError:
+                pass
+        return confirmed
+
+    def delete_missing(self, crm_ids):
+        """
+        Записи, которых больше нет в crm, удаляются как при 404 в одиночном пулле
+        """
+        deleted = set()
+        crm_ids = self.confirm_missing(crm_ids)
+        if not crm_ids:
+            return deleted
+        with transaction.atomic():
+            for crm_id, instance in self.lock_instances(crm_ids)[0].items():
+                if self.instance_perform_delete(instance):
+                    deleted.add(crm_id)
+        return deleted
+
+    def report_error(self, crm_id, err):
+        action = f'{self.serializer_class.Meta.model.crm_api_path}/{crm_id}'
+        self.client.request('PATCH', action=action, params={'syncFailed': str(err)})
+
+    def post(self, request, *args, **kwargs):
+        crm_ids = self.get_crm_ids(request)
+        results = self.apply_many(self.fetch_records(crm_ids))
+        deleted = self.delete_missing([crm_id for crm_id in crm_ids if crm_id not in results])
+        data = OrderedDict()
+        for crm_id in crm_ids:
+            result = results.get(crm_id)
+            if isinstance(result, Exception):
+                self.report_error(crm_id, result)
+                data[crm_id] = {'status': 'error', 'error': str(result)}
+            elif result is not None:
+                data[crm_id] = {'status': 'ok'}
+            elif crm_id in deleted:
+                data[crm_id] = {'status': 'deleted'}
+            else:
+                data[crm_id] = {'status': 'not_found'}
+        return Response(data, status=status.HTTP_200_OK)
+
+
 class CRMContactView(CRMBaseView):
     serializer_class = CRMPetuniUserSerializer
     queryset = PetuniUser.objects.all()
@@ -142,7 +357,20 @@ class CRMClinicServiceOfferView(CRMBaseView):
     queryset = CRMServiceOffer.objects.all()
 
 
-class CRMAccountPullView(EspoClientMixin, views.APIView):
+class CRMContactBulkPullView(CRMBulkPullMixin, CRMContactView):
+    pass
+
+
+class CRMAccountScheduleBulkPullView(CRMBulkPullMixin, CRMAccountScheduleView):
+    pass
+
+
+class CRMClinicServiceOfferBulkPullView(CRMBulkPullMixin, CRMClinicServiceOfferView):
+    pass
+
+
+@method_decorator(transaction.non_atomic_requests, name='dispatch')
+class CRMAccountPullView(CRMPullViewMixin, CRMEspoClientMixin, views.APIView):
     permission_classes = [CRMEnabledAndIsAdminPermissions]
     type_dict = {
         'Приют для животных': {
@@ -161,33 +389,28 @@ class CRMAccountPullView(EspoClientMixin, views.APIView):
         }
     }
 
+    def get_categories_data(self, crm_id):
+        return self.client.request('GET', action=f'Account/{crm_id}/accountCategories')['list']
+
     def get_account_data(self, crm_id):
         """
         По Account.crm_id вернем данные запроса и список accountCategories.name
-        (список имен категорий аккаунта, как они представлены в crm)
+        (список имен категорий аккаунта, как они представлены в crm).
+        Категории - отдельная связь в Espo, оба запроса идут параллельно
         """
-        try:
-            account_data = self.client.request('GET', action=f'Account/{crm_id}')
-        except EspoAPI404Error as err: # Если срм ответила 404, удалим приют и клинику
-            Shelter.objects.filter(crm_id=crm_id).delete()
-            Clinic.objects.filter(crm_id=crm_id).delete()
-            raise err
-        categories_data = self.client.request('GET', action=f'Account/{crm_id}/accountCategories')['list']
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            account_future = executor.submit(self.client.request, 'GET', f'Account/{crm_id}')
+            categories_future = executor.submit(self.get_categories_data, crm_id)
+            try:
+                account_data = account_future.result()
+            except EspoAPI404Error as err: # Если срм ответила 404, удалим приют и клинику
+                with transaction.atomic():
+                    Shelter.objects.filter(crm_id=crm_id).delete()
+                    Clinic.objects.filter(crm_id=crm_id).delete()
+                raise err
+            categories_data = categories_future.result()
         return account_data, categories_data
     
-    def save_via_pk(self, data, category_name):
-        pk = data.get(self.type_dict[category_name]['pk_field'])
-        queryset = self.type_dict[category_name]['queryset']
-        serializer_class = self.type_dict[category_name]['serializer']
-        try:
-            instance = queryset.get(pk=pk)
-            serializer = serializer_class(instance, data)
-            serializer.is_valid(raise_exception=True)
-            serializer.save()
-            return serializer
-        except ObjectDoesNotExist:
-            return None
-    
     @staticmethod
     def is_for_sync(account_data, category_data):
         """
@@ -197,43 +420,99 @@ class CRMAccountPullView(EspoClientMixin, views.APIView):
             return account_data['djangoShelter'] # and account_data['shelterApprovalStatus'] == 'Approved'
         return True
 
+    def find_instance(self, data, category_name, queryset):
+        """
+        Приют или клиника аккаунта: по petuniId категории, иначе по crm_id
+        """
+        pk = data.get(self.type_dict[category_name]['pk_field'])
+        if pk:
+            instance = queryset.filter(pk=pk).first()
+            if instance is not None:
+                return instance
+        return queryset.filter(crm_id=data['id']).first()
+
+    def validate_account(self, account_data, category_name, instance=None):
+        serializer_class = self.type_dict[category_name]['serializer']
+        if instance is not None:
+            serializer = serializer_class(instance, account_data)
+        else:
+            serializer = serializer_class(data=account_data)
+        serializer.is_valid(raise_exception=True)
+        return serializer
+
+    def prepare_account(self, account_data, categories_data):
+        """
+        Валидирует аккаунт для каждой его категории без блокировок
+        (валидация адреса ходит в gmaps). Отдает {category_name: serializer},
+        пустой, если у аккаунта нет категории для синка (не клиника и не приют)
+        """
+        serializers = OrderedDict()
+        for category_data in categories_data:
+            if not self.is_for_sync(account_data, category_data):
+                continue
+            category_name = category_data['name']
+            if category_name in self.type_dict:
+                queryset = self.type_dict[category_name]['queryset']
+                instance = self.find_instance(account_data, category_name, queryset)
+                serializers[category_name] = self.validate_account(
+                    account_data, category_name, instance
+                )
+        return serializers
+
+    def save_account(self, account_data, serializers):
+        """
+        Блокирует приют и клинику аккаунта и пишет провалидированные данные.
+        Отдает сериализатор последней сохраненной категории
+        """
+        serializer = None
+        for category_name, serializer in serializers.items():
+            queryset = self.type_dict[category_name]['queryset'].select_for_update()
+            locked = None
+            if serializer.instance is not None:
+                locked = queryset.filter(pk=serializer.instance.pk).first()
+            if locked is None:
+                locked = self.find_instance(account_data, category_name, queryset)
+            serializer = self.save_validated(
+                serializer, locked,
+                lambda instance: self.validate_account(account_data, category_name, instance)
+            )
+        return serializer
+
+    def apply_many(self, records):
+        """
+        Сохраняет пачку аккаунтов из crm, каждый в своей транзакции.
+        Категории у Espo отдельной связью, поэтому догружаются на каждый аккаунт.
+        Возвращает {crm_id: serializer, None или исключение}
+        """
+        results = OrderedDict()
+        for account_data in records:
+            crm_id = account_data['id']
+            try:
+                categories_data = self.get_categories_data(crm_id)
+                serializers = self.prepare_account(account_data, categories_data)
+                with transaction.atomic():
+                    results[crm_id] = self.save_account(account_data, serializers)
+            except Exception as err:
+                results[crm_id] = err
+        return results
+
     def post(self, request, *args, **kwargs):
         crm_id = self.kwargs['crm_id']
-        types = self.type_dict.copy()
-        for val in types.values():
-            queryset = val['queryset'].filter(crm_id=crm_id).select_for_update()
-            try:
-                val['instance'] = queryset.get()
-            except val['model'].DoesNotExist:
-                val['instance'] = None
         action = f'Account/{crm_id}'
         try:
             account_data, categories_data = self.get_account_data(crm_id)
             # self.address_restruct(account_data)
-            is_category_valid = False # Проверка на наличие типа аккаунта, клиника или приют
-            for category_data in categories_data:
-                if not self.is_for_sync(account_data, category_data):
-                    continue
-                category_name = category_data['name']
-                if category_name in types:
-                    is_category_valid = True
-                    serializer = self.save_via_pk(account_data, category_name)
-                    if serializer is None:
-                        serializer_class = types[category_name]['serializer']
-                        if types[category_name]['instance']:
-                            serializer = serializer_class(types[category_name]['instance'],
-                                                        account_data)
-                        else:
-                            serializer = serializer_class(data=account_data)
-                        serializer.is_valid(raise_exception=True)
-                        serializer.save()
-            if not is_category_valid: # если категория не приют и не клиника отправим репорт
+            serializers = self.prepare_account(account_data, categories_data)
+            if not serializers: # если категория не приют и не клиника отправим репорт
                 self.client.request(
                     'PATCH',
                     action=action,
                     params={'syncFailed': "account type not specified. choose clinic or shelter"}
                 )
                 return Response(status=status.HTTP_400_BAD_REQUEST)
+            # приют и клинику блокируем только на время записи, не на время запросов в crm
+            with transaction.atomic():
+                serializer = self.save_account(account_data, serializers)
             return Response(serializer.data, status=status.HTTP_200_OK)
         except EspoAPI404Error:
             return Response(status=status.HTTP_204_NO_CONTENT)